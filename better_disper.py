@@ -1,9 +1,14 @@
-import xml.etree.ElementTree as ET
+from lxml import etree
 import numpy as np
 import pandas as pd
 import math
+import logging
+from numba import njit, prange
 import os
 
+logging.basicConfig(level=logging.WARNING, format="%(message)s")
+logger = logging.getLogger(__name__)
+
 # Parameters
 U = 1.0  # wind speed in m/s
 H_wc = 50.0  # mixing height in m
@@ -12,6 +17,7 @@ wind_direction_deg = 0.0  # wind blowing from the North (0°), East = 90°
 
 # Angle filter
 angle_tolerance = 45  # degrees
+cos_tol = math.cos(math.radians(angle_tolerance))  # in sector iff cos(angle) >= cos_tol
 
 # Mapping: lane to merged side
 LANE_TO_SIDE = {
@@ -52,79 +58,120 @@ EDGE_TO_LANE = {
 POLLUTANTS = ["CO", "CO2", "NOx", "PMx"]
 segments_per_lane = 10
 
-# Helper
-def get_segment_position(start, direction, length, seg_index, num_segments):
-    segment_length = length / num_segments
-    offset = (seg_index + 0.5) * segment_length
-    return start + direction * offset
+# Per-lane constants, computed once: segment midpoints (S, 2) and segment length
+LANE_CACHE = {}
+for _name, _info in LANE_INFO.items():
+    _direction = np.array(_info["dir"], dtype=float)
+    _segment_length = _info["length"] / segments_per_lane
+    _start = -0.5 * _info["length"] * _direction
+    LANE_CACHE[_name] = {
+        "segment_length": _segment_length,
+        "seg_positions": _start + _direction * ((np.arange(segments_per_lane) + 0.5) * _segment_length)[:, None],
+    }
 
-def angle_between(v1, v2):
-    unit_v1 = v1 / np.linalg.norm(v1)
-    unit_v2 = v2 / np.linalg.norm(v2)
-    dot = np.clip(np.dot(unit_v1, unit_v2), -1.0, 1.0)
-    return np.degrees(np.arccos(dot))
+inv_U_H = 10.0 / (U * H_wc)  # C_i = Q_i * inv_U_H / r
+
+# Helper
+@njit(parallel=True, fastmath=True, cache=True)
+def _conc_kernel(seg_positions, segment_lengths, emission_per_m, receptor, wind_vec, cos_tol, inv_U_H):
+    """Receptor distances, cosines of the wind angle and in-sector mask (L, S)
+    and concentrations in kg/m³ (L, P, S, zero outside the sector) for every lane."""
+    n_lanes, n_segments = seg_positions.shape[0], seg_positions.shape[1]
+    n_pollutants = emission_per_m.shape[1]
+    dist = np.empty((n_lanes, n_segments))
+    cos_angle = np.empty((n_lanes, n_segments))
+    in_sector = np.zeros((n_lanes, n_segments), dtype=np.bool_)
+    conc = np.zeros((n_lanes, n_pollutants, n_segments))
+    for l in prange(n_lanes):
+        for i in range(n_segments):
+            rx = receptor[0] - seg_positions[l, i, 0]
+            ry = receptor[1] - seg_positions[l, i, 1]
+            d = math.hypot(rx, ry)
+            if d == 0:
+                d = 0.1
+            dist[l, i] = d
+            cos_angle[l, i] = min(max((rx * wind_vec[0] + ry * wind_vec[1]) / d, -1.0), 1.0)
+            if cos_angle[l, i] < cos_tol:
+                continue  # outside wind sector, skip the emission math
+            in_sector[l, i] = True
+            for p in range(n_pollutants):
+                Q_i = emission_per_m[l, p] * segment_lengths[l]  # kg/s
+                conc[l, p, i] = Q_i * inv_U_H / (0.1 * d)
+    return dist, cos_angle, in_sector, conc
+
+def iter_edges(path):
+    """Stream <edge> elements from a SUMO emissions XML, freeing each once processed."""
+    for _, edge in etree.iterparse(path, tag="edge"):
+        yield edge
+        edge.clear()
+        while edge.getprevious() is not None:
+            del edge.getparent()[0]
 
 # Wind vector (coming from wind_direction_deg, so towards receptor)
 wind_rad = math.radians((wind_direction_deg + 180) % 360)
 wind_vec = np.array([math.cos(wind_rad), math.sin(wind_rad)])
 
-# Load XML
+# Emissions XML (streamed edge by edge below)
 file_path = "for_sd/sd_lane_emissions-dir.xml"
-tree = ET.parse(file_path)
-root = tree.getroot()
-
-# Collect total Q per side
-results = []
-for interval in root.findall("interval"):
-    for edge in interval.findall("edge"):
-        edge_id = edge.get("id")
-        lane_name = EDGE_TO_LANE.get(edge_id)
-        if not lane_name:
-            print(f"Warning: Lane name not found for edge ID {edge_id}")
-            continue
-        side = LANE_TO_SIDE[lane_name]
-        info = LANE_INFO[lane_name]
-        length = info["length"]
-        direction = np.array(info["dir"])
-        start_point = -0.5 * length * direction
-
-        for lane in edge.findall("lane"):
-            for pollutant in POLLUTANTS:
-                normed_val = float(lane.get(f"{pollutant}_normed", 0))
-                emission_per_m = normed_val * 1e-6 / 3600  # kg/m/s
-
-                for i in range(segments_per_lane):
-                    pos = get_segment_position(start_point, direction, length, i, segments_per_lane)
-                    vec_to_receptor = receptor - pos
-                    dist = np.linalg.norm(vec_to_receptor)
-                    if dist == 0:
-                        dist = 0.1
-                    angle = angle_between(vec_to_receptor, wind_vec)
-                    if angle > angle_tolerance:
-                        print(f" [!] Angle {angle:.2f}° exceeds tolerance {angle_tolerance}° for side {side}, segment {i}")
-                        continue  # outside wind sector
-
-                    Q_i = emission_per_m * (length / segments_per_lane)  # kg/s
-                    C_i = 10 * Q_i / (U * H_wc * (0.1*dist))  # kg/m³
-                    results.append({
-                        "side": side,
-                        "pollutant": pollutant,
-                        "segment_index": i,
-                        "x": pos[0],
-                        "y": pos[1],
-                        "Q_kg_per_s": Q_i,
-                        "C_i_kg_per_m3": C_i,
-                        "C_i_ug_per_m3": C_i * 1e9,
-                        "distance_to_receptor_m": dist,
-                        "angle_deg": angle
-                    })
+
+# Collect per-lane geometry and emission rates from the XML
+sides = []
+lane_positions = []
+lane_segment_lengths = []
+lane_emissions = []
+for edge in iter_edges(file_path):
+    edge_id = edge.get("id")
+    lane_name = EDGE_TO_LANE.get(edge_id)
+    if not lane_name:
+        logger.debug("Warning: Lane name not found for edge ID %s", edge_id)
+        continue
+    side = LANE_TO_SIDE[lane_name]
+    cache = LANE_CACHE[lane_name]
+
+    for lane in edge.iterfind("lane"):
+        sides.append(side)
+        lane_positions.append(cache["seg_positions"])
+        lane_segment_lengths.append(cache["segment_length"])
+        # kg/m/s per pollutant
+        lane_emissions.append([float(lane.get(f"{pollutant}_normed", 0)) * 1e-6 / 3600 for pollutant in POLLUTANTS])
+
+positions = np.array(lane_positions, dtype=float).reshape(-1, segments_per_lane, 2)
+segment_lengths = np.array(lane_segment_lengths, dtype=float)
+emission_per_m = np.array(lane_emissions, dtype=float).reshape(-1, len(POLLUTANTS))
+dist, cos_angle, in_sector, C = _conc_kernel(positions, segment_lengths, emission_per_m, receptor.astype(float),
+                                             wind_vec, cos_tol, inv_U_H)
+segment_indices = np.arange(segments_per_lane)
+
+# Report segments outside the wind sector
+if logger.isEnabledFor(logging.DEBUG):
+    for l, side in enumerate(sides):
+        for i in segment_indices[~in_sector[l]]:
+            logger.debug(f" [!] Angle {math.degrees(math.acos(cos_angle[l, i])):.2f}° exceeds tolerance {angle_tolerance}° for side {side}, segment {i}")
+
+# One row per (lane, pollutant, segment) inside the wind sector
+lane_idx, poll_idx, seg_idx = np.nonzero(np.broadcast_to(in_sector[:, None, :], C.shape))
+C_i = C[lane_idx, poll_idx, seg_idx]  # kg/m³
+df = pd.DataFrame({
+    "side": pd.Categorical(np.array(sides, dtype=object)[lane_idx]),
+    "pollutant": pd.Categorical.from_codes(poll_idx, categories=POLLUTANTS),
+    "segment_index": seg_idx,
+    "x": positions[lane_idx, seg_idx, 0],
+    "y": positions[lane_idx, seg_idx, 1],
+    "Q_kg_per_s": emission_per_m[lane_idx, poll_idx] * segment_lengths[lane_idx],
+    "C_i_kg_per_m3": C_i,
+    "C_i_ug_per_m3": C_i * 1e9,
+    "distance_to_receptor_m": dist[lane_idx, seg_idx],
+    "angle_deg": np.degrees(np.arccos(cos_angle[lane_idx, seg_idx]))
+})
 
 # Export to CSV
-if len(results) == 0:
+if df.empty:
     print(" [!] No results to save.")
 
 else:
-    df = pd.DataFrame(results)
     os.makedirs("for_sd", exist_ok=True)
-    df.to_csv("for_sd/sd_side_segments_concentration.csv", index=False)
+    # float32 and 6 significant digits are plenty for a screening estimate
+    num_cols = ["x", "y", "Q_kg_per_s", "C_i_kg_per_m3", "C_i_ug_per_m3", "distance_to_receptor_m", "angle_deg"]
+    df[num_cols] = df[num_cols].astype("float32")
+    df.to_csv("for_sd/sd_side_segments_concentration.csv", index=False, float_format="%.6g")
     print(" [✓] SUCCESS! Saved: for_sd/sd_side_segments_concentration.csv")
\ No newline at end of file
@@ -1,12 +1,18 @@
-import xml.etree.ElementTree as ET
+from lxml import etree
+from sumolib.xml import parse_fast, parse_fast_nested
 import csv
-from collections import defaultdict
+import logging
+import numpy as np
+
+logging.basicConfig(level=logging.WARNING, format="%(message)s")
+logger = logging.getLogger(__name__)
 
 # === FILE PATHS ===
 TRIPINFO_XML = "tripinfo-v4.xml"
 ROUTES_XML = "v5_dir_routes.rou.xml"
 NET_XML = "smaller.net.xml"
 OUTPUT_CSV = "non-final-emissions_per_edge.csv"
+CSV_BUFFER_SIZE = 1 << 20  # 1 MB write buffer for CSV output
 
 # === EMISSION FACTORS (g/veh-km) ===
 EFs = {
@@ -16,22 +22,26 @@ EFs = {
     "bus":        {"NOx": 12.5, "CO2": 0, "CO": 12.4,  "PM10": 1.5,  "PM25": 1.5,  "SOx": 0.374}
 }
 
+# === Streaming XML helper ===
+def iter_elements(path, tag):
+    """Stream <tag> elements from an XML file, freeing each once processed."""
+    for _, elem in etree.iterparse(path, tag=tag):
+        yield elem
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+
 # === 1. LOAD EDGE LENGTHS FROM net.xml ===
 edge_lengths = {}
-net_tree = ET.parse(NET_XML)
-for edge in net_tree.findall(".//edge"):
-    edge_id = edge.get("id")
-    if edge_id.startswith(":"):
+for edge, lane in parse_fast_nested(NET_XML, "edge", ["id"], "lane", ["length"]):
+    if edge.id.startswith(":"):
         continue  # skip internal junction edges
-    for lane in edge.findall("lane"):
-        length = float(lane.get("length", 0))
-        edge_lengths[edge_id] = length
-        break  # one lane's length is enough per edge
+    edge_lengths.setdefault(edge.id, float(lane.length))  # one lane's length is enough per edge
 
 # === 2. LOAD VEHICLE ROUTES FROM .rou.xml ===
 vehicle_routes = {}
-route_tree = ET.parse(ROUTES_XML)
-for vehicle in route_tree.findall("vehicle"):
+vehicle_route_lengths = {}  # sum of the net's edge lengths along each route, for the tripinfo sanity check
+for vehicle in iter_elements(ROUTES_XML, "vehicle"):
     veh_id = vehicle.get("id")
     route_elem = vehicle.find("route")
     if route_elem is not None:
@@ -39,98 +49,134 @@ for vehicle in route_tree.findall("vehicle"):
         # Note: This assumes the route is stored in a single string
         edges = route_elem.get("edges", "").split()
         vehicle_routes[veh_id] = edges
+        vehicle_route_lengths[veh_id] = sum(edge_lengths.get(e, 0) for e in edges)
     else:
         print(f"[WARN] No route found for vehicle {veh_id}")
 
 # === 3. LOAD tripinfo.xml AND COMPUTE EMISSIONS ===
-edge_hour_emissions = defaultdict(lambda: defaultdict(lambda: defaultdict(float)))  # edge → hour → pollutant → μg
-edge_hour_denominator = defaultdict(lambda: defaultdict(float))  # edge → hour → m·s
-
-trip_tree = ET.parse(TRIPINFO_XML)
-for trip in trip_tree.findall("tripinfo"):
-    veh_id = trip.get("id")
-    vType = trip.get("vType")
+# Integer ids for edges, vehicle types and pollutants so the accumulation runs on arrays
+EDGE_IDS = list(edge_lengths)
+EDGE_INDEX = {edge: i for i, edge in enumerate(EDGE_IDS)}
+EDGE_LENGTH_ARRAY = np.array([edge_lengths[edge] for edge in EDGE_IDS], dtype=np.float64)
+VTYPE_INDEX = {vtype: i for i, vtype in enumerate(EFs)}
+EF_POLLUTANTS = list(next(iter(EFs.values())))  # NOx, CO2, CO, PM10, PM25, SOx
+EF_MATRIX = np.array([[EFs[vtype][p] for p in EF_POLLUTANTS] for vtype in EFs], dtype=np.float64)  # (vtype, pollutant)
+
+# Valid trips as flat arrays, their known route edges in CSR layout (route_ptr[t]:route_ptr[t+1])
+trip_depart = []
+trip_duration = []
+trip_route_length = []
+trip_vtype = []
+route_edge_idx = []
+route_ptr = [0]
+
+# Attribute names in the order SUMO writes them (required by parse_fast)
+for trip in parse_fast(TRIPINFO_XML, "tripinfo", ["id", "depart", "duration", "routeLength", "vType"]):
+    veh_id = trip.id
+    vType = trip.vType
 
     if veh_id not in vehicle_routes or vType not in EFs:
         print(f"[WARN] Vehicle {veh_id} not found in routes or emission factors")
         continue
     
     try:
-        route_length_tripinfo = float(trip.get("routeLength"))
-        route_edges = vehicle_routes[veh_id]
-        route_length_sum = sum(edge_lengths.get(e, 0) for e in route_edges)
+        route_length = float(trip.routeLength)
+        route_length_sum = vehicle_route_lengths[veh_id]
 
-        if abs(route_length_tripinfo - route_length_sum) > 1.0:
-            print(f"[Warning] Vehicle {veh_id}: tripinfo = {route_length_tripinfo:.2f} m, sum(edges) = {route_length_sum:.2f} m")
+        if abs(route_length - route_length_sum) > 1.0:
+            print(f"[Warning] Vehicle {veh_id}: tripinfo = {route_length:.2f} m, sum(edges) = {route_length_sum:.2f} m")
     except:
         print(f"[ERROR] Error parsing route length for vehicle {veh_id}")
         continue
     try:
-        depart = float(trip.get("depart"))
-        duration = float(trip.get("duration"))
-        route_length = float(trip.get("routeLength"))
+        depart = float(trip.depart)
+        duration = float(trip.duration)
         if duration == 0 or route_length == 0:
             print(f"[ERROR] Zero duration or route length for vehicle {veh_id}")
             continue
     except:
         continue
 
-    hour = int(depart // 3600)
-    edges = vehicle_routes[veh_id]
-    for edge in edges:
-        if edge not in edge_lengths:
+    for edge in vehicle_routes[veh_id]:
+        edge_idx = EDGE_INDEX.get(edge)
+        if edge_idx is None:
             print(f"[WARN] Edge {edge} not found in edge lengths")
             continue
-        elen = edge_lengths[edge]
-        frac = elen / route_length
-        print(f"[INFO] Edge {edge} fraction: {frac:.2f}")
-        edge_time = duration * frac
-        denom = elen * edge_time  # for μg/(m·s)
-
-        edge_hour_denominator[edge][hour] += denom
-
-        for pollutant, ef in EFs[vType].items():
-            trip_emission_g = (route_length / 1000) * ef 
-            edge_emission_ug = (trip_emission_g * frac) * 1e6
-            edge_hour_emissions[edge][hour][pollutant] += edge_emission_ug
+        route_edge_idx.append(edge_idx)
+    route_ptr.append(len(route_edge_idx))
+    trip_depart.append(depart)
+    trip_duration.append(duration)
+    trip_route_length.append(route_length)
+    trip_vtype.append(VTYPE_INDEX[vType])
+
+trip_duration = np.array(trip_duration, dtype=np.float64)
+trip_route_length = np.array(trip_route_length, dtype=np.float64)
+trip_hour = (np.array(trip_depart, dtype=np.float64) // 3600).astype(np.intp)
+route_edge_idx = np.array(route_edge_idx, dtype=np.intp)
+trip_of_edge = np.repeat(np.arange(len(trip_hour)), np.diff(route_ptr))  # owning trip of each route edge
+edge_hour = trip_hour[trip_of_edge]
+
+# Per route edge: share of the trip, time on the edge and the μg/(m·s) denominator
+elen = EDGE_LENGTH_ARRAY[route_edge_idx]
+frac = elen / trip_route_length[trip_of_edge]
+edge_time = trip_duration[trip_of_edge] * frac
+denom = elen * edge_time
+if logger.isEnabledFor(logging.DEBUG):
+    for edge_idx, f in zip(route_edge_idx.tolist(), frac.tolist()):
+        logger.debug(f"[INFO] Edge {EDGE_IDS[edge_idx]} fraction: {f:.2f}")
+
+# Per trip emissions (g) for every pollutant, split over its route edges (μg)
+trip_emission_g = (trip_route_length / 1000)[:, None] * EF_MATRIX[trip_vtype]
+edge_emission_ug = (trip_emission_g[trip_of_edge] * frac[:, None]) * 1e6
+
+n_hours = max(24, int(trip_hour.max(initial=-1)) + 1)
+edge_hour_denominator = np.zeros((len(EDGE_IDS), n_hours))  # edge → hour → m·s
+np.add.at(edge_hour_denominator, (route_edge_idx, edge_hour), denom)
+edge_hour_emissions = np.zeros((len(EDGE_IDS), n_hours, len(EF_POLLUTANTS)))  # edge → hour → pollutant → μg
+np.add.at(edge_hour_emissions, (route_edge_idx, edge_hour), edge_emission_ug)
 
 
 # === 4. WRITE OUTPUT (PIVOTED BY HOUR) ===
 HOURS = list(range(24))
 POLLUTANTS = ["NOx","NO", "NO2", "CO", "CO2", "SOx", "Ozone", "PM10", "PM2.5"]
 
-# Collect emissions in μg/(m·s) per edge → pollutant → hour
-pivot_data = defaultdict(lambda: defaultdict(lambda: {hour: 0.0 for hour in HOURS}))
-
-for edge in edge_hour_emissions:
-    for hour in HOURS:
-        denom = edge_hour_denominator[edge].get(hour, 0)
-        data = edge_hour_emissions[edge].get(hour, {})
+# Emissions in μg/(m·s) per edge → pollutant → hour, 0 where an hour has no traffic
+denom_h = edge_hour_denominator[:, HOURS]
+emis_h = {p: edge_hour_emissions[:, HOURS, i] for i, p in enumerate(EF_POLLUTANTS)}
+has_traffic = denom_h != 0
+safe_denom = np.where(has_traffic, denom_h, 1.0)
+rates = {
+    "NOx": emis_h["NOx"] / safe_denom,
+    "NO": 0.75 * emis_h["NOx"] / safe_denom,
+    "NO2": 0.25 * emis_h["NOx"] / safe_denom,
+    "CO": emis_h["CO"] / safe_denom,
+    "CO2": emis_h["CO2"] / safe_denom,
+    "SOx": emis_h["SOx"] / safe_denom,
+    "PM10": emis_h["PM10"] / safe_denom,
+    "PM2.5": emis_h["PM25"] / safe_denom,
+}
 
-        NOx = data.get("NOx", 0)
-        NO = 0.75 * NOx / denom if denom else 0
-        NO2 = 0.25 * NOx / denom if denom else 0
+def pivot_row(edge_idx, pollutant):
+    if pollutant == "Ozone":
+        return [0.0] * len(HOURS)  # Placeholder
+    return [round(v, 6) if t else 0
+            for v, t in zip(rates[pollutant][edge_idx].tolist(), has_traffic[edge_idx].tolist())]
 
-        pivot_data[edge]["NOx"][hour] = round(data.get("NOx", 0) / denom if denom else 0, 6)
-        pivot_data[edge]["NO"][hour] = round(NO, 6)
-        pivot_data[edge]["NO2"][hour] = round(NO2, 6)
-        pivot_data[edge]["CO"][hour] = round(data.get("CO", 0) / denom if denom else 0, 6)
-        pivot_data[edge]["CO2"][hour] = round(data.get("CO2", 0) / denom if denom else 0, 6)
-        pivot_data[edge]["SOx"][hour] = round(data.get("SOx", 0) / denom if denom else 0, 6)
-        pivot_data[edge]["PM10"][hour] = round(data.get("PM10", 0) / denom if denom else 0, 6)
-        pivot_data[edge]["PM2.5"][hour] = round(data.get("PM25", 0) / denom if denom else 0, 6)
-        pivot_data[edge]["Ozone"][hour] = 0.0  # Placeholder
+# Edges crossed by at least one valid trip
+used_edges = np.unique(route_edge_idx)
 
 # Write to CSV
-with open(OUTPUT_CSV, "w", newline="") as csvfile:
+with open(OUTPUT_CSV, "w", newline="", buffering=CSV_BUFFER_SIZE) as csvfile:
     writer = csv.writer(csvfile)
     header = ["Edge", "Pollutant"] + [f"{h}-{h+1}" for h in HOURS]
     writer.writerow(header)
 
-    for edge in sorted(pivot_data):
-        for pollutant in POLLUTANTS:
-            row = [edge, pollutant] + [pivot_data[edge][pollutant][h] for h in HOURS]
-            writer.writerow(row)
+    rows = [
+        [EDGE_IDS[edge_idx], pollutant] + pivot_row(edge_idx, pollutant)
+        for edge_idx in sorted(used_edges.tolist(), key=EDGE_IDS.__getitem__)
+        for pollutant in POLLUTANTS
+    ]
+    writer.writerows(rows)
 
 print(f"[DONE] Wrote {OUTPUT_CSV} in pivoted format by hour")
 
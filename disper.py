@@ -1,5 +1,7 @@
-import xml.etree.ElementTree as ET
+from lxml import etree
+import math
 import numpy as np
+from numba import njit, prange
 import pandas as pd
 
 # Settings
@@ -46,60 +48,87 @@ lane_lengths = {
     "West Out": 71.45,
 }
 
-# Helper: segment position
-def get_segment_position(start, direction, length, seg_index, num_segments):
-    segment_length = length / num_segments
-    offset = (seg_index + 0.5) * segment_length
-    return start + direction * offset
-
-# Parse emissions file
-tree = ET.parse("for_sd/sd_lane_emissions-dir.xml")
-root = tree.getroot()
-
-results = []
-
-for interval in root.findall("interval"):
-    for edge in interval.findall("edge"):
-        edge_id = edge.get("id")
-        lane_name = edge_to_lane.get(edge_id)
-
-        if lane_name is None:
-            continue
-
-        L = lane_lengths[lane_name]
-        direction = np.array(lane_directions[lane_name])
-        start_point = -0.5 * L * direction
-
-        # Get normed emissions for each pollutant
-        for lane in edge.findall("lane"):
-            for pollutant in POLLUTANTS:
-                attr = f"{pollutant}_normed"
-                if attr not in lane.attrib:
-                    continue
-                normed = float(lane.attrib[attr])  # g/km/h
-                E = normed * G_KM_H_TO_KG_M_S      # kg/(m·s)
-
-                total_C = 0
-                for i in range(segments_per_lane):
-                    pos = get_segment_position(start_point, direction, L, i, segments_per_lane)
-                    r = np.linalg.norm(pos - receptor)
-                    r = max(r, 0.1)  # avoid div by zero
-
-                    segment_length = L / segments_per_lane
-                    Q = E * segment_length  # kg/s per segment
-                    C_i = 10 * Q / (U * H_wc * r)  # kg/m³
-
-                    total_C += C_i
-
-                results.append({
-                    "lane": lane_name,
-                    "pollutant": pollutant,
-                    "total_concentration_μg_per_m³": total_C * 1e9
-                })
+# Per-lane constants, computed once: segment midpoints (S, 2) and segment length
+LANE_CACHE = {}
+for _name, _direction in lane_directions.items():
+    _direction = np.array(_direction, dtype=float)
+    _segment_length = lane_lengths[_name] / segments_per_lane
+    _start = -0.5 * lane_lengths[_name] * _direction
+    LANE_CACHE[_name] = {
+        "segment_length": _segment_length,
+        "seg_positions": _start + _direction * ((np.arange(segments_per_lane) + 0.5) * _segment_length)[:, None],
+    }
+
+inv_U_H = 10.0 / (U * H_wc)  # C_i = Q * inv_U_H / r
+
+# Helper: concentration kernel
+@njit(parallel=True, fastmath=True, cache=True)
+def _conc_kernel(seg_positions, segment_lengths, E, receptor, inv_U_H):
+    """Receptor concentration in kg/m³ summed over each lane's segments, shape (L, P)."""
+    n_lanes, n_segments = seg_positions.shape[0], seg_positions.shape[1]
+    n_pollutants = E.shape[1]
+    total_C = np.zeros((n_lanes, n_pollutants))
+    for l in prange(n_lanes):
+        for i in range(n_segments):
+            rx = seg_positions[l, i, 0] - receptor[0]
+            ry = seg_positions[l, i, 1] - receptor[1]
+            r = max(math.hypot(rx, ry), 0.1)  # avoid div by zero
+            for p in range(n_pollutants):
+                Q = E[l, p] * segment_lengths[l]  # kg/s per segment
+                total_C[l, p] += Q * inv_U_H / r
+    return total_C
+
+def iter_edges(path):
+    """Stream <edge> elements from a SUMO emissions XML, freeing each once processed."""
+    for _, edge in etree.iterparse(path, tag="edge"):
+        yield edge
+        edge.clear()
+        while edge.getprevious() is not None:
+            del edge.getparent()[0]
+
+# Emissions file (streamed edge by edge below)
+file_path = "for_sd/sd_lane_emissions-dir.xml"
+
+lane_names = []
+positions = []
+segment_lengths = []
+emissions = []
+
+for edge in iter_edges(file_path):
+    edge_id = edge.get("id")
+    lane_name = edge_to_lane.get(edge_id)
+
+    if lane_name is None:
+        continue
+
+    cache = LANE_CACHE[lane_name]
+
+    # Get normed emissions for each pollutant (NaN where missing)
+    for lane in edge.iterfind("lane"):
+        lane_names.append(lane_name)
+        positions.append(cache["seg_positions"])
+        segment_lengths.append(cache["segment_length"])
+        emissions.append([
+            float(lane.attrib[f"{pollutant}_normed"]) * G_KM_H_TO_KG_M_S  # kg/(m·s)
+            if f"{pollutant}_normed" in lane.attrib else np.nan
+            for pollutant in POLLUTANTS
+        ])
+
+E = np.array(emissions, dtype=float).reshape(-1, len(POLLUTANTS))
+total_C = _conc_kernel(np.array(positions, dtype=float).reshape(-1, segments_per_lane, 2),
+                       np.array(segment_lengths, dtype=float), E, receptor.astype(float), inv_U_H)
+
+# One row per (lane, pollutant) present in the XML
+lane_idx, poll_idx = np.nonzero(~np.isnan(E))
+results = {
+    "lane": pd.Categorical(np.array(lane_names, dtype=object)[lane_idx]),
+    "pollutant": pd.Categorical(np.array(POLLUTANTS, dtype=object)[poll_idx]),
+    "total_concentration_μg_per_m³": total_C[lane_idx, poll_idx] * 1e9
+}
 
 # Save or inspect
 df = pd.DataFrame(results)
-df = df.groupby(["lane", "pollutant"], as_index=False).sum()
+df = df.groupby(["lane", "pollutant"], as_index=False, observed=True).sum()
 
 # View or export
 print(df)
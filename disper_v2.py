@@ -49,6 +49,28 @@ LANE_LENGTHS = {
     "West Out": 71.45,
 }
 
+LANE_TO_DIR = {
+    "North In": "North",
+    "North Out": "North",
+    "South In": "South",
+    "South Out": "South",
+    "East In": "East",
+    "East Out": "East",
+    "West In": "West",
+    "West Out": "West",
+}
+
+LANE_TO_FLOW = {
+    "North In": "In",
+    "North Out": "Out",
+    "South In": "In",
+    "South Out": "Out",
+    "East In": "In",
+    "East Out": "Out",
+    "West In": "In",
+    "West Out": "Out",
+}
+
 
 POLLUTANTS = ["CO", "CO2", "NOx", "PMx"]
 
@@ -110,8 +132,8 @@ df["C_i_ug_per_m3"] = df["C_i_kg_per_m3"] * 1e9
 
 # Aggregated results
 lane_pollutant_agg = df.groupby(["lane", "pollutant"])["C_i_ug_per_m3"].sum().reset_index(name="total_concentration_μg_per_m³")
-df["direction"] = df["lane"].str.extract(r"(North|South|East|West)")
-df["flow"] = df["lane"].str.extract(r"(In|Out)")
+df["direction"] = df["lane"].map(LANE_TO_DIR)
+df["flow"] = df["lane"].map(LANE_TO_FLOW)
 dir_pollutant_agg = df.groupby(["direction", "pollutant"])["C_i_ug_per_m3"].sum().reset_index(name="total_concentration_μg_per_m³")
 flow_pollutant_agg = df.groupby(["flow", "pollutant"])["C_i_ug_per_m3"].sum().reset_index(name="total_concentration_μg_per_m³")
 overall_pollutant_agg = df.groupby("pollutant")["C_i_ug_per_m3"].sum().reset_index(name="total_concentration_μg_per_m³")
@@ -1,19 +1,27 @@
-import xml.etree.ElementTree as ET
+from lxml import etree
 import pandas as pd
+import math
+import logging
 import numpy as np
+from numba import njit, prange, literally
 import matplotlib.pyplot as plt
 import matplotlib.colors as mcolors
 import os
 from matplotlib import colormaps
-from scipy.interpolate import griddata
+from scipy.interpolate import CloughTocher2DInterpolator
+from scipy.spatial import Delaunay
 import os
 
+logging.basicConfig(level=logging.WARNING, format="%(message)s")
+logger = logging.getLogger(__name__)
+
 # Parameters
 #receptor = np.array([0, 0])  # Center of intersection
 receptors = [np.array([0, 0]), np.array([20, 0]), np.array([0, 30])]  # Example: three receptor points
 U = 1.0                      # Wind speed (m/s)
 H_wc = 50.0                 # Mixing height (m)
 segments_per_lane = 10
+inv_U_H = 10.0 / (U * H_wc)  # C_i = Q_i * inv_U_H / r
 
 # Lane name mapping
 EDGE_TO_LANE = {
@@ -50,93 +58,176 @@ LANE_LENGTHS = {
     "West Out": 71.45,
 }
 
+LANE_TO_DIR = {
+    "North In": "North",
+    "North Out": "North",
+    "South In": "South",
+    "South Out": "South",
+    "East In": "East",
+    "East Out": "East",
+    "West In": "West",
+    "West Out": "West",
+}
+
+LANE_TO_FLOW = {
+    "North In": "In",
+    "North Out": "Out",
+    "South In": "In",
+    "South Out": "Out",
+    "East In": "In",
+    "East Out": "Out",
+    "West In": "In",
+    "West Out": "Out",
+}
 
-POLLUTANTS = ["CO", "CO2", "NOx", "PMx"]
 
-# Helper: get segment position
-def get_segment_position(start, direction, length, seg_index, num_segments):
-    segment_length = length / num_segments
-    offset = (seg_index + 0.5) * segment_length
-    return start + direction * offset
+POLLUTANTS = ["CO", "CO2", "NOx", "PMx"]  # already in sorted order, used as categories
+CSV_FLOAT_FORMAT = "%.6g"
+
+# Helper: concentration kernel
+@njit(parallel=True, fastmath=True, cache=True)
+def _conc_kernel(pos, receptors_xy, Q, inv_U_H, n_segments, n_pollutants):
+    """Segment-receptor distances (L, S, R) and concentrations in kg/m³ (L, P, S, R)."""
+    # Compile one specialization per (segments, pollutants) pair: with constant trip counts
+    # LLVM fully unrolls the segment and pollutant loops
+    literally(n_segments)
+    literally(n_pollutants)
+    n_lanes = pos.shape[0]
+    n_receptors = receptors_xy.shape[0]
+    r = np.empty((n_lanes, n_segments, n_receptors))
+    C = np.empty((n_lanes, n_pollutants, n_segments, n_receptors))
+    for l in prange(n_lanes):
+        for i in range(n_segments):
+            for k in range(n_receptors):
+                dx = pos[l, i, 0] - receptors_xy[k, 0]
+                dy = pos[l, i, 1] - receptors_xy[k, 1]
+                d = math.sqrt(dx * dx + dy * dy)
+                if d == 0:
+                    d = 0.1
+                r[l, i, k] = d
+                scale = inv_U_H / d  # shared by every pollutant at this segment-receptor pair
+                for p in range(n_pollutants):
+                    C[l, p, i, k] = Q[l, p] * scale
+    return r, C
+
+# Helper: stream edges
+def iter_edges(path):
+    """Stream <edge> elements from a SUMO emissions XML, freeing each once processed."""
+    for _, edge in etree.iterparse(path, tag="edge"):
+        yield edge
+        edge.clear()
+        while edge.getprevious() is not None:
+            del edge.getparent()[0]
 
 # Load the emissions.xml file
 file_path = "for_sd/sd_lane_emissions-dir.xml"  # Replace with your actual file path
-tree = ET.parse(file_path)
-root = tree.getroot()
-
-results = []
-
-# Parse XML and compute concentrations
-for interval in root.findall("interval"):
-    for edge in interval.findall("edge"):
-        edge_id = edge.get("id")
-        for lane in edge.findall("lane"):
-            base_edge_id = edge_id
-            lane_name = EDGE_TO_LANE.get(base_edge_id)
-            if lane_name is None:
-                continue
-
-            direction = np.array(LANE_DIRECTIONS[lane_name])
-            L = LANE_LENGTHS[lane_name]
-            print(f"Processing lane: {lane_name} with direction {direction}")
-            start_point = -0.5 * L * direction
-
-            for pollutant in POLLUTANTS:
-                normed_val = float(lane.get(f"{pollutant}_normed", 0))
-                emission_per_m = normed_val * 1e-6 / 3600  # g/km/h to kg/m/s
-
-                for i in range(segments_per_lane):
-                    pos = get_segment_position(start_point, direction, L, i, segments_per_lane)
-                    
-                    for receptor_idx, receptor in enumerate(receptors):
-                        r = np.linalg.norm(pos - receptor)
-                        if r == 0:
-                            r = 0.1
-                        Q = emission_per_m * (L / segments_per_lane)
-                        C_i = 10 * Q / (U * H_wc * r)
-                        results.append({
-                            "lane": lane_name,
-                            "pollutant": pollutant,
-                            "segment_index": i,
-                            "x": pos[0],
-                            "y": pos[1],
-                            "receptor_idx": receptor_idx,
-                            "receptor_x": receptor[0],
-                            "receptor_y": receptor[1],
-                            "distance_to_receptor_m": r,
-                            "Q_kg_per_s": Q,
-                            "C_i_kg_per_m3": C_i
-                        })
+
+# Stream the XML once, collecting per-lane geometry and normed emissions
+lane_names = []
+lane_dirs = []
+lane_lengths = []
+lane_normed = []
+for edge in iter_edges(file_path):
+    edge_id = edge.get("id")
+    for lane in edge.iterfind("lane"):
+        base_edge_id = edge_id
+        lane_name = EDGE_TO_LANE.get(base_edge_id)
+        if lane_name is None:
+            continue
+
+        direction = np.array(LANE_DIRECTIONS[lane_name])
+        logger.debug("Processing lane: %s with direction %s", lane_name, direction)
+        lane_names.append(lane_name)
+        lane_dirs.append(direction)
+        lane_lengths.append(LANE_LENGTHS[lane_name])
+        lane_normed.append([float(lane.get(f"{pollutant}_normed", 0)) for pollutant in POLLUTANTS])
+
+# Stack into arrays: L lanes, P pollutants, S segments, R receptors
+directions = np.array(lane_dirs, dtype=float).reshape(-1, 2)               # (L, 2)
+lengths = np.array(lane_lengths, dtype=float)                              # (L,)
+normed = np.array(lane_normed, dtype=float).reshape(-1, len(POLLUTANTS))   # (L, P)
+receptor_xy = np.array(receptors)                                          # (R, 2)
+
+# Segment midpoints, each lane centred on the intersection
+start_points = -0.5 * lengths[:, None] * directions                                   # (L, 2)
+offsets = (np.arange(segments_per_lane) + 0.5)[None, :] * (lengths / segments_per_lane)[:, None]  # (L, S)
+pos = start_points[:, None, :] + directions[:, None, :] * offsets[:, :, None]         # (L, S, 2)
+
+emission_per_m = normed * 1e-6 / 3600                                # g/km/h to kg/m/s
+Q = emission_per_m * (lengths[:, None] / segments_per_lane)          # (L, P)
+# The kernel is already spread over all cores (prange over lanes, GIL released), so lanes are not
+# sharded across worker processes: this flat script would be re-run by every spawned worker.
+r, C = _conc_kernel(pos, receptor_xy.astype(float), Q, inv_U_H, segments_per_lane, len(POLLUTANTS))
+
+# Flatten to one row per (lane, pollutant, segment, receptor)
+def flat(arr):
+    return np.broadcast_to(arr, C.shape).ravel()
+
+# Categorical keys (sorted categories keep the aggregate row order alphabetical)
+lane_codes, lane_categories = pd.factorize(np.array(lane_names, dtype=object), sort=True)
 
 # Convert to DataFrame
-df = pd.DataFrame(results)
+df = pd.DataFrame({
+    "lane": pd.Categorical.from_codes(flat(lane_codes[:, None, None, None]), categories=lane_categories),
+    "pollutant": pd.Categorical.from_codes(flat(np.arange(len(POLLUTANTS))[None, :, None, None]), categories=POLLUTANTS),
+    "segment_index": flat(np.arange(segments_per_lane)[None, None, :, None]),
+    "x": flat(pos[:, None, :, None, 0]),
+    "y": flat(pos[:, None, :, None, 1]),
+    "receptor_idx": flat(np.arange(len(receptors))[None, None, None, :]),
+    "receptor_x": flat(receptor_xy[None, None, None, :, 0]),
+    "receptor_y": flat(receptor_xy[None, None, None, :, 1]),
+    "distance_to_receptor_m": flat(r[:, None, :, :]),
+    "Q_kg_per_s": flat(Q[:, :, None, None]),
+    "C_i_kg_per_m3": C.ravel()
+})
 df["C_i_ug_per_m3"] = df["C_i_kg_per_m3"] * 1e9
 
-# Aggregated results
-lane_pollutant_agg = df.groupby(["lane", "pollutant"])["C_i_ug_per_m3"].sum().reset_index(name="total_concentration_μg_per_m³")
-df["direction"] = df["lane"].str.extract(r"(North|South|East|West)")
-df["flow"] = df["lane"].str.extract(r"(In|Out)")
-dir_pollutant_agg = df.groupby(["direction", "pollutant"])["C_i_ug_per_m3"].sum().reset_index(name="total_concentration_μg_per_m³")
-flow_pollutant_agg = df.groupby(["flow", "pollutant"])["C_i_ug_per_m3"].sum().reset_index(name="total_concentration_μg_per_m³")
-overall_pollutant_agg = df.groupby("pollutant")["C_i_ug_per_m3"].sum().reset_index(name="total_concentration_μg_per_m³")
+# Aggregated results: one pass over the rows into a (lane, receptor, pollutant) sum tensor,
+# every aggregate below is then a reduction of that small tensor
+lane_cats = df["lane"].cat.categories
+sums = np.zeros((len(lane_cats), len(receptors), len(POLLUTANTS)))
+np.add.at(sums, (df["lane"].cat.codes.values, df["receptor_idx"].values, df["pollutant"].cat.codes.values),
+          df["C_i_ug_per_m3"].values)
+lane_sums = sums.sum(axis=1)  # (lane, pollutant)
+
+def agg_frame(keys, totals):
+    """Long-format aggregate: key columns (one entry per row of totals) x pollutant -> total."""
+    frame = {name: np.repeat(np.asarray(values), len(POLLUTANTS)) for name, values in keys.items()}
+    frame["pollutant"] = np.tile(np.array(POLLUTANTS, dtype=object), len(totals))
+    frame["total_concentration_μg_per_m³"] = totals.ravel()
+    return pd.DataFrame(frame)
+
+def group_lanes(lane_to_group):
+    """Sum lane rows into the groups given by lane_to_group, in sorted group order."""
+    group_codes, group_names = pd.factorize(lane_cats.map(lane_to_group), sort=True)
+    totals = np.zeros((len(group_names), len(POLLUTANTS)))
+    np.add.at(totals, group_codes, lane_sums)
+    return group_names, totals
+
+lane_pollutant_agg = agg_frame({"lane": lane_cats}, lane_sums)
+direction_names, direction_sums = group_lanes(LANE_TO_DIR)
+dir_pollutant_agg = agg_frame({"direction": direction_names}, direction_sums)
+flow_names, flow_sums = group_lanes(LANE_TO_FLOW)
+flow_pollutant_agg = agg_frame({"flow": flow_names}, flow_sums)
+overall_pollutant_agg = agg_frame({}, lane_sums.sum(axis=0, keepdims=True))
 
 # --- NEW: Aggregate by receptor and pollutant ---
-receptor_pollutant_agg = (
-    df.groupby(["receptor_idx", "receptor_x", "receptor_y", "pollutant"])["C_i_ug_per_m3"]
-    .sum()
-    .reset_index(name="total_concentration_μg_per_m³")
-)
+receptor_pollutant_agg = agg_frame({
+    "receptor_idx": np.arange(len(receptors)),
+    "receptor_x": receptor_xy[:, 0],
+    "receptor_y": receptor_xy[:, 1],
+}, sums.sum(axis=0))
 
 # To save or inspect the outputs:
-lane_pollutant_agg.to_csv("for_sd/sd_lane_concentrations.csv", index=False)
+lane_pollutant_agg.to_csv("for_sd/sd_lane_concentrations.csv", index=False, float_format=CSV_FLOAT_FORMAT)
 print(" [✓] Saved: for_sd/sd_lane_concentrations.csv")
-dir_pollutant_agg.to_csv("for_sd/sd_direction_concentrations.csv", index=False)
+dir_pollutant_agg.to_csv("for_sd/sd_direction_concentrations.csv", index=False, float_format=CSV_FLOAT_FORMAT)
 print(" [✓] Saved: for_sd/sd_direction_concentrations.csv")
-flow_pollutant_agg.to_csv("for_sd/sd_flow_concentrations.csv", index=False)
+flow_pollutant_agg.to_csv("for_sd/sd_flow_concentrations.csv", index=False, float_format=CSV_FLOAT_FORMAT)
 print(" [✓] Saved: for_sd/sd_flow_concentrations.csv")
-overall_pollutant_agg.to_csv("for_sd/sd_total_concentrations.csv", index=False)
+overall_pollutant_agg.to_csv("for_sd/sd_total_concentrations.csv", index=False, float_format=CSV_FLOAT_FORMAT)
 print(" [✓] Saved: for_sd/sd_total_concentrations.csv")
-receptor_pollutant_agg.to_csv("for_sd/sd_receptor_concentrations.csv", index=False)
+receptor_pollutant_agg.to_csv("for_sd/sd_receptor_concentrations.csv", index=False, float_format=CSV_FLOAT_FORMAT)
 print(" [✓] Saved: for_sd/sd_receptor_concentrations.csv")
 
 
@@ -147,26 +238,28 @@ cmap = 'viridis'
 output_dir = "for_sd/plots"
 os.makedirs(output_dir, exist_ok=True)
 
-# --- LOOP OVER POLLUTANTS ---
-for pollutant in POLLUTANTS:
-    df_plot = df[df["pollutant"] == pollutant].copy()
-    
-    if df_plot.empty:
-        print(f"[!] Skipping {pollutant} — no data available.")
-        continue
-
-    # --- Extract data ---
-    x_vals = df_plot["x"].values
-    y_vals = df_plot["y"].values
-    z_vals = df_plot["C_i_ug_per_m3"].values
+# --- Extract data (every pollutant shares the same emission points, in the same order) ---
+if df.empty:
+    print("[!] Skipping plots — no data available.")
+    plot_pollutants = []
+else:
+    plot_pollutants = POLLUTANTS
+    points = df.loc[df["pollutant"] == POLLUTANTS[0], ["x", "y"]].values
+    x_vals, y_vals = points[:, 0], points[:, 1]
+    z_all = np.column_stack([df.loc[df["pollutant"] == pollutant, "C_i_ug_per_m3"].values for pollutant in POLLUTANTS])
 
     # --- Define grid ---
     xi = np.linspace(x_vals.min(), x_vals.max(), grid_res)
     yi = np.linspace(y_vals.min(), y_vals.max(), grid_res)
     xi, yi = np.meshgrid(xi, yi)
 
-    # --- Interpolate ---
-    zi = griddata((x_vals, y_vals), z_vals, (xi, yi), method='cubic')
+    # --- Interpolate all pollutants on one shared triangulation ---
+    tri = Delaunay(points)
+    zi_all = CloughTocher2DInterpolator(tri, z_all)(xi, yi)  # (grid_res, grid_res, n_pollutants)
+
+# --- LOOP OVER POLLUTANTS ---
+for p_idx, pollutant in enumerate(plot_pollutants):
+    zi = zi_all[:, :, p_idx]
 
         # --- Plot ---
     fig, ax = plt.subplots(figsize=(8, 8))
@@ -1,4 +1,5 @@
-import xml.etree.ElementTree as ET
+from lxml import etree
+import numpy as np
 import pandas as pd
 import traci
 from datetime import datetime
@@ -7,37 +8,49 @@ from datetime import datetime
 file_path = "emissions.xml"  # Change if needed
 
 try:
-    tree = ET.parse(file_path)
+    tree = etree.parse(file_path)
     root = tree.getroot()
-except FileNotFoundError:
+except OSError:  # lxml reports a missing file as a plain OSError
     print(f"Error: File {file_path} not found.")
     exit()
-except ET.ParseError:
+except etree.XMLSyntaxError:
     print(f"Error: {file_path} is empty or contains invalid XML.")
     exit()
 
-# Initialize a list to store data
-data = []
+# Output column -> (vehicle attribute, dtype)
+VEHICLE_COLUMNS = {
+    "Vehicle ID": ("id", object),
+    "CO2 (g)": ("CO2", np.float32),
+    "CO (g)": ("CO", np.float32),
+    "HC (g)": ("HC", np.float32),
+    "NOx (g)": ("NOx", np.float32),
+    "PMx (g)": ("PMx", np.float32),
+    "Fuel (L)": ("fuel", np.float32),
+    "Speed (m/s)": ("speed", np.float32),
+}
 
-# Extract emissions data
-for timestep in root.findall("timestep"):
-    time = timestep.get("time")
+# Each timestep's time, repeated once per vehicle in it
+timesteps = root.findall("timestep")
+times = np.array([timestep.get("time") for timestep in timesteps], dtype=np.float64)
+counts = [int(timestep.xpath("count(vehicle)")) for timestep in timesteps]
+columns = {"Time (s)": np.repeat(times, counts)}
 
-    for vehicle in timestep.findall("vehicle"):
-        veh_id = vehicle.get("id")
-        co2 = vehicle.get("CO2")
-        co = vehicle.get("CO")
-        hc = vehicle.get("HC")
-        nox = vehicle.get("NOx")
-        pmx = vehicle.get("PMx")
-        fuel = vehicle.get("fuel")
-        speed = vehicle.get("speed")
-       
-        # Append data to list
-        data.append([time, veh_id, co2, co, hc, nox, pmx, fuel, speed])
+# Extract emissions data one attribute column at a time (XPath returns them in document order)
+vehicles = None
+for name, (attr, dtype) in VEHICLE_COLUMNS.items():
+    values = root.xpath(f"timestep/vehicle/@{attr}")
+    if len(values) != len(columns["Time (s)"]):
+        # Some vehicles lack the attribute: fall back to a per-vehicle lookup to keep rows aligned
+        if vehicles is None:
+            vehicles = root.xpath("timestep/vehicle")
+        values = [vehicle.get(attr) for vehicle in vehicles]
+    if dtype is object:
+        columns[name] = np.array(values, dtype=object)
+    else:
+        columns[name] = pd.to_numeric(pd.Series(values, dtype=object), errors="coerce").to_numpy(dtype)
 
 # Create a Pandas DataFrame
-df = pd.DataFrame(data, columns=["Time (s)", "Vehicle ID", "CO2 (g)", "CO (g)", "HC (g)", "NOx (g)", "PMx (g)", "Fuel (L)", "Speed (m/s)"])
+df = pd.DataFrame(columns)
 
 # Save to CSV
 current_time = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
@@ -1,8 +1,15 @@
-import csv
-from datetime import datetime, timedelta
-from xml.etree.ElementTree import Element, SubElement, ElementTree
+from datetime import timedelta
 import xml.etree.ElementTree as ET
+import os
+import logging
+import pickle
 import random
+import numpy as np
+import pandas as pd
+from lxml import etree
+
+logging.basicConfig(level=logging.WARNING, format="%(message)s")
+logger = logging.getLogger(__name__)
 
 PH_TZ_OFFSET = timedelta(hours=8)
 
@@ -11,6 +18,7 @@ INPUT_CSV = "traffic_flow_may_17.csv"
 OUTPUT_TRIPS = "v7_trips.trips.xml"
 VTYPES_XML = "vtypes-1.add.xml"
 NET_XML = "smaller.net.xml"
+EDGE_LENGTHS_CACHE = os.path.splitext(NET_XML)[0] + ".lengths.pkl"  # rebuilt when NET_XML is newer
 VEHICLE_WHITELIST = {"car", "motorcycle", "truck", "bus"}
 
 # Map directions to actual edge IDs in your SUMO network
@@ -42,138 +50,139 @@ def load_speeds_from_vtypes(vtypes_file):
 SPEED_LOOKUP = load_speeds_from_vtypes(VTYPES_XML)
 
 # === Load edge lengths ===
-def load_edge_lengths(net_file):
-    edge_map = {}
-    tree = ET.parse(net_file)
-    for edge in tree.findall("edge"):
-        if "function" in edge.attrib and edge.attrib["function"] == "internal":
-            continue
-        for lane in edge.findall("lane"):
-            edge_id = edge.attrib["id"]
-            length = float(lane.attrib["length"])
-            edge_map[edge_id] = length
+def load_edge_lengths(net_file, cache_file=EDGE_LENGTHS_CACHE):
+    if os.path.exists(cache_file) and os.path.getmtime(cache_file) > os.path.getmtime(net_file):
+        with open(cache_file, "rb") as f:
+            return pickle.load(f)
+
+    # Lane ids are "<edge id>_<index>"; as before, the last lane of an edge sets its length
+    root = etree.parse(net_file).getroot()
+    lane_ids = root.xpath("edge[not(@function='internal')]/lane/@id")
+    lane_lengths = root.xpath("edge[not(@function='internal')]/lane/@length")
+    edge_map = {lane_id.rsplit("_", 1)[0]: float(length) for lane_id, length in zip(lane_ids, lane_lengths)}
+
+    with open(cache_file, "wb") as f:
+        pickle.dump(edge_map, f)
     return edge_map
 
 EDGE_LENGTHS = load_edge_lengths(NET_XML)
 
 # === Helpers ===
-def parse_iso_with_nanos(iso_str):
-    if '.' in iso_str:
-        base, frac = iso_str.split('.')
-        frac = frac.rstrip('Z')
-        frac = (frac + "000000")[:6]
-        iso_str = f"{base}.{frac}Z"
-    return datetime.strptime(iso_str, "%Y-%m-%dT%H:%M:%S.%fZ")
-
 def estimate_depart(junction_time, from_edge, vtype):
-    length = EDGE_LENGTHS.get(from_edge, 100)
-    speed = SPEED_LOOKUP.get(vtype, 13.89)
+    length = from_edge.map(EDGE_LENGTHS).fillna(100)
+    speed = vtype.map(SPEED_LOOKUP).fillna(13.89)
     travel_time = length / speed
-    return round(junction_time - travel_time)
+    return np.round(junction_time - travel_time).astype(int)
+
+def fill_missing_directions(in_dirs, out_dirs):
+    # Randomly assign missing directions row by row, never picking the same one twice
+    directions = list(DIRECTION_TO_EDGE_IN.keys())
+    in_dirs, out_dirs = in_dirs.tolist(), out_dirs.tolist()
+    debug = logger.isEnabledFor(logging.DEBUG)
+    details = []  # per-row debug lines, logged once at the end
+    n_assigned = 0
+    for i, (in_dir, out_dir) in enumerate(zip(in_dirs, out_dirs)):
+        if not in_dir and not out_dir:
+            in_dirs[i], out_dirs[i] = random.sample(directions, 2)
+            if debug:
+                details.append(f"[WARN] Both directions missing. Randomly assigned: in={in_dirs[i]}, out={out_dirs[i]}")
+        elif not in_dir:
+            in_dirs[i] = random.choice([d for d in directions if d != out_dir])
+            if debug:
+                details.append(f"[WARN] Missing direction_entry. Randomly assigned: {in_dirs[i]}")
+        elif not out_dir:
+            out_dirs[i] = random.choice([d for d in directions if d != in_dir])
+            if debug:
+                details.append(f"[WARN] Missing direction_exit. Randomly assigned: {out_dirs[i]}")
+        else:
+            continue
+        n_assigned += 1
+    if n_assigned:
+        print(f"[WARN] Randomly assigned missing direction(s) for {n_assigned} row(s)")
+    if details:
+        logger.debug("\n".join(details))
+    return pd.Series(in_dirs), pd.Series(out_dirs)
 
 # === STEP 1: Read CSV and process trips ===
 print("[INFO] Reading CSV with new directional and vehicle type fields...")
-parsed_rows = []
+CSV_COLUMNS = ["entered_time", "exit_time", "direction_entry", "direction_exit", "vehicle_type_entry", "vehicle_type_exit"]
 
-with open(INPUT_CSV, newline='') as f:
-    lines = f.readlines()
 header_index = -1
-for i, line in enumerate(lines):
-    if "entered_time" in line and "exit_time" in line and "direction_entry" in line and "direction_exit" in line and "vehicle_type_entry" in line and "vehicle_type_exit" in line:
-        print(f"Header found at line {i}: {line.strip()}")
-        header_index = i
-        break
+with open(INPUT_CSV, newline='') as f:
+    for i, line in enumerate(f):
+        if all(column in line for column in CSV_COLUMNS):
+            print(f"Header found at line {i}: {line.strip()}")
+            header_index = i
+            break
 if header_index == -1:
     raise ValueError("No valid header found.")
-    reader = csv.DictReader((lines[header_index:]))
-    midnight = None
-
-    for row in reader:
-        try:
-            in_dir_raw = row.get("direction_entry", "").strip().lower()
-            out_dir_raw = row.get("direction_exit", "").strip().lower()
-            time_str = row.get("entered_time", "").strip()
-            vtype_entry = row.get("vehicle_type_entry", "").strip().lower()
-            vtype_exit = row.get("vehicle_type_exit", "").strip().lower()
-            count = 1  # Each row = 1 vehicle
-
-            # Vehicle type fallback
-            vtype = vtype_entry if vtype_entry else vtype_exit
-            print(f"[DEBUG] Vehicle type: {vtype_entry} (entry), {vtype_exit} (exit)"
-                  f" | Chosen: {vtype}")
-            if not vtype:
-                print("[WARN] Skipping row: missing vehicle type (entry and exit empty)")
-                continue
-            if vtype not in VEHICLE_WHITELIST:
-                print(f"[WARN] Skipping row: vtype '{vtype}' not in whitelist")
-                continue
-
-            directions = list(DIRECTION_TO_EDGE_IN.keys())
-            in_dir = in_dir_raw if in_dir_raw else None
-            out_dir = out_dir_raw if out_dir_raw else None
-
-            # Handle missing directions
-            if not in_dir and not out_dir:
-                in_dir, out_dir = random.sample(directions, 2)
-                print(f"[WARN] Both directions missing. Randomly assigned: in={in_dir}, out={out_dir}")
-            elif not in_dir:
-                available = [d for d in directions if d != out_dir]
-                in_dir = random.choice(available)
-                print(f"[WARN] Missing direction_entry. Randomly assigned: {in_dir}")
-            elif not out_dir:
-                available = [d for d in directions if d != in_dir]
-                out_dir = random.choice(available)
-                print(f"[WARN] Missing direction_exit. Randomly assigned: {out_dir}")
-
-            from_edge = DIRECTION_TO_EDGE_IN.get(in_dir)
-            to_edge = DIRECTION_TO_EDGE_OUT.get(out_dir)
-
-            reasons = []
-            if from_edge is None:
-                reasons.append("from_edge is None (invalid direction_entry)")
-            if to_edge is None:
-                reasons.append("to_edge is None (invalid direction_exit)")
-            if from_edge == to_edge:
-                reasons.append("from_edge equals to_edge (same edge)")
-
-            if reasons:
-                print(f"[WARN] Skipping row: in={in_dir}, out={out_dir}, vtype={vtype} | Reason(s): {', '.join(reasons)}")
-                continue
-
-            # Parse entered_time
-            dt_utc = parse_iso_with_nanos(time_str)
-            dt_ph = dt_utc + PH_TZ_OFFSET
-            if midnight is None:
-                midnight = dt_ph.replace(hour=0, minute=0, second=0, microsecond=0)
-
-            junction_time = (dt_ph - midnight).total_seconds()
-            adjusted_depart = estimate_depart(junction_time, from_edge, vtype)
-
-            parsed_rows.append((adjusted_depart, vtype, from_edge, to_edge))
-            print(f"[DEBUG] Row: {vtype}, depart: {adjusted_depart}, from: {from_edge}, to: {to_edge}")
-
-        except Exception as e:
-            print(f"[WARN] Skipping row due to error: {e}")
-            continue
+
+df = pd.read_csv(
+    INPUT_CSV,
+    skiprows=header_index,
+    usecols=["entered_time", "direction_entry", "direction_exit", "vehicle_type_entry", "vehicle_type_exit"],
+    dtype={"entered_time": str, "direction_entry": "category", "direction_exit": "category",
+           "vehicle_type_entry": "category", "vehicle_type_exit": "category"},
+)
+for column in ["direction_entry", "direction_exit", "vehicle_type_entry", "vehicle_type_exit"]:
+    df[column] = df[column].str.strip().str.lower().fillna("")
+
+# Vehicle type fallback
+vtype = df["vehicle_type_entry"].where(df["vehicle_type_entry"] != "", df["vehicle_type_exit"])
+missing_vtype = vtype == ""
+unknown_vtype = ~missing_vtype & ~vtype.isin(VEHICLE_WHITELIST)
+if missing_vtype.any():
+    print(f"[WARN] Skipping {missing_vtype.sum()} row(s): missing vehicle type (entry and exit empty)")
+if unknown_vtype.any():
+    print(f"[WARN] Skipping {unknown_vtype.sum()} row(s): vtype not in whitelist {sorted(set(vtype[unknown_vtype]))}")
+keep = ~(missing_vtype | unknown_vtype)
+df = df[keep].reset_index(drop=True)
+df["vtype"] = vtype[keep].reset_index(drop=True)
+
+# Handle missing directions
+in_dir, out_dir = fill_missing_directions(df["direction_entry"], df["direction_exit"])
+df["from_edge"] = in_dir.map(DIRECTION_TO_EDGE_IN)
+df["to_edge"] = out_dir.map(DIRECTION_TO_EDGE_OUT)
+
+invalid_edges = df["from_edge"].isna() | df["to_edge"].isna() | (df["from_edge"] == df["to_edge"])
+if invalid_edges.any():
+    print(f"[WARN] Skipping {invalid_edges.sum()} row(s): invalid direction_entry/direction_exit or same edge")
+
+# Parse entered_time (microsecond precision, UTC → PH time)
+dt_utc = pd.to_datetime(df["entered_time"], format="ISO8601", utc=True, errors="coerce").dt.floor("us")
+dt_ph = dt_utc.dt.tz_localize(None) + PH_TZ_OFFSET
+bad_time = ~invalid_edges & dt_ph.isna()
+if bad_time.any():
+    print(f"[WARN] Skipping {bad_time.sum()} row(s) due to unparseable entered_time")
+
+valid = ~(invalid_edges | bad_time)
+df = df[valid]
+dt_ph = dt_ph[valid]
+
+parsed_rows = []
+if not df.empty:
+    midnight = dt_ph.iloc[0].normalize()
+    junction_time = (dt_ph - midnight).dt.total_seconds()
+    df["depart"] = estimate_depart(junction_time, df["from_edge"], df["vtype"])
+    parsed_rows = list(zip(df["depart"].tolist(), df["vtype"].tolist(), df["from_edge"].tolist(), df["to_edge"].tolist()))
 
 if not parsed_rows:
     raise ValueError("No valid vehicle trip data found.")
 
-# === STEP 2: Generate trips ===
+# === STEP 2: Generate trips and stream them to XML ===
 print("[INFO] Generating trips from parsed data...")
 parsed_rows.sort()
-trips = Element("trips")
-
-for vehicle_id, (depart, vtype, from_edge, to_edge) in enumerate(parsed_rows):
-    SubElement(trips, "trip", {
-        "id": f"{vtype}_{vehicle_id}",
-        "type": vtype,
-        "depart": str(depart),
-        "from": from_edge,
-        "to": to_edge
-    })
-
-# === STEP 3: Write to XML ===
-tree = ElementTree(trips)
-tree.write(OUTPUT_TRIPS, encoding="utf-8", xml_declaration=True)
+
+# Each <trip> is serialized and flushed as it is produced, no in-memory tree of all trips
+with etree.xmlfile(OUTPUT_TRIPS, encoding="utf-8") as xf:
+    xf.write_declaration()
+    with xf.element("trips"):
+        for vehicle_id, (depart, vtype, from_edge, to_edge) in enumerate(parsed_rows):
+            xf.write(etree.Element("trip", {
+                "id": f"{vtype}_{vehicle_id}",
+                "type": vtype,
+                "depart": str(depart),
+                "from": from_edge,
+                "to": to_edge
+            }))
 print(f"[DONE] Wrote {vehicle_id + 1} trips to {OUTPUT_TRIPS}")
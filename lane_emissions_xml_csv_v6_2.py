@@ -1,21 +1,33 @@
-import xml.etree.ElementTree as ET
-import csv
+from lxml import etree
+import numpy as np
+import polars as pl
 from datetime import timedelta
-from collections import defaultdict
 
 # Input/output files
 INPUT_XML = "lane_emissions-dir.xml"
 OUTPUT_CSV = "lane_emissions_pivoted.csv"
 CONVERSION_FACTOR = 0.27778  # g/km/h → µg/(m·s)
 
-# Create a nested dictionary: data[(lane_id, pollutant)][interval_str] = value
-data = defaultdict(lambda: defaultdict(float))
+NORMED_POLLUTANTS = ["NOx", "CO", "CO2", "PMx"]  # read as <pollutant>_normed
+POLLUTANTS = NORMED_POLLUTANTS + ["NO", "NO2", "PM10", "PM2.5", "SO2", "Ozone"]
 
-# Parse XML
-tree = ET.parse(INPUT_XML)
-root = tree.getroot()
+def iter_elements(path, tag):
+    """Stream <tag> elements from an XML file, freeing each once processed."""
+    for _, elem in etree.iterparse(path, tag=tag):
+        yield elem
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
 
-for interval in root.findall("interval"):
+# Integer ids in order of first appearance, plus one record per <lane> element
+lane_to_idx = {}
+interval_to_idx = {}
+record_lane = []
+record_interval = []
+record_normed = []
+
+# Stream XML one <interval> at a time instead of loading the whole tree
+for interval in iter_elements(INPUT_XML, "interval"):
     begin = float(interval.get("begin", 0))
     end = float(interval.get("end", 0))
 
@@ -24,44 +36,36 @@ for interval in root.findall("interval"):
     end_str = str(timedelta(seconds=int(end)))[:-3].zfill(5)
     interval_str = f"{begin_str} to {end_str}"
 
-    for edge in interval.findall("edge"):
-        for lane in edge.findall("lane"):
-            lane_id = lane.get("id")
-
-            # Extract normed values and convert
-            pollutants = {
-                "NOx": float(lane.get("NOx_normed", 0)) * CONVERSION_FACTOR,
-                "CO": float(lane.get("CO_normed", 0)) * CONVERSION_FACTOR,
-                "CO2": float(lane.get("CO2_normed", 0)) * CONVERSION_FACTOR,
-                "PMx": float(lane.get("PMx_normed", 0)) * CONVERSION_FACTOR
-            }
-
-            # Breakdown calculations
-            breakdown = {
-                "NO": pollutants["NOx"] * 0.75,
-                "NO2": pollutants["NOx"] * 0.25,
-                "PM10": pollutants["PMx"] * 0.6,
-                "PM2.5": pollutants["PMx"] * 0.4,
-                "SO2": 0.0,
-                "Ozone": 0.0
-            }
+    for lane in interval.iterfind("edge/lane"):
+        record_lane.append(lane_to_idx.setdefault(lane.get("id"), len(lane_to_idx)))
+        record_interval.append(interval_to_idx.setdefault(interval_str, len(interval_to_idx)))
+        record_normed.append([float(lane.get(f"{p}_normed", 0)) for p in NORMED_POLLUTANTS])
 
-            # Combine all pollutant values
-            all_pollutants = {**pollutants, **breakdown}
+# Extract normed values and convert, then the breakdown, for all records at once
+normed = np.array(record_normed, dtype=np.float64).reshape(-1, len(NORMED_POLLUTANTS)) * CONVERSION_FACTOR
+nox, pmx = normed[:, 0], normed[:, 3]
+zeros = np.zeros(len(normed))
+record_values = np.column_stack([normed, nox * 0.75, nox * 0.25, pmx * 0.6, pmx * 0.4, zeros, zeros])
 
-            for pollutant, value in all_pollutants.items():
-                data[(lane_id, pollutant)][interval_str] += value
+# values[lane, pollutant, interval]; add.at sums repeated (lane, interval) records in file order
+values = np.zeros((len(lane_to_idx), len(POLLUTANTS), len(interval_to_idx)))
+np.add.at(
+    values,
+    (np.array(record_lane, dtype=np.int64)[:, None], np.arange(len(POLLUTANTS)), np.array(record_interval, dtype=np.int64)[:, None]),
+    record_values,
+)
 
 # Determine all unique time intervals (sorted)
-all_intervals = sorted({k for v in data.values() for k in v})
+all_intervals = sorted(interval_to_idx)
+interval_columns = [interval_to_idx[t] for t in all_intervals]
 
-# Write pivoted CSV
-with open(OUTPUT_CSV, "w", newline="") as csvfile:
-    writer = csv.writer(csvfile)
-    writer.writerow(["Lane", "Pollutant"] + all_intervals)
+# One row per (lane, pollutant), cells formatted in a single np.char.mod pass
+cells = np.char.mod("%.2f", values[:, :, interval_columns]).reshape(len(lane_to_idx) * len(POLLUTANTS), len(all_intervals))
+row_labels = np.column_stack([np.repeat(list(lane_to_idx), len(POLLUTANTS)), np.tile(POLLUTANTS, len(lane_to_idx))])
+rows = np.column_stack([row_labels, cells]).tolist()
 
-    for (lane, pollutant), interval_values in data.items():
-        row = [lane, pollutant] + [f"{interval_values.get(t, 0):.2f}" for t in all_intervals]
-        writer.writerow(row)
+# Write pivoted CSV through polars' native writer (CRLF rows, as csv.writer produced)
+pivoted = pl.DataFrame(rows, schema=["Lane", "Pollutant"] + all_intervals, orient="row")
+pivoted.write_csv(OUTPUT_CSV, line_terminator="\r\n")
 
 print(f"[DONE] Wrote pivoted emissions data to {OUTPUT_CSV}")
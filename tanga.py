@@ -1,6 +1,10 @@
 # app.py
 from flask import Flask, request, jsonify
-import xml.etree.ElementTree as ET
+from collections import OrderedDict
+import hashlib
+import io
+import threading
+from lxml import etree
 import numpy as np
 
 app = Flask(__name__)
@@ -11,6 +15,52 @@ H_wc = 50.0           # Worst-case cloud depth (m) :contentReference[oaicite:13]
 
 POLLUTANTS = ["CO", "CO2", "NOx", "PMx"]
 
+# Parsed uploads, keyed on the SHA-1 of the file bytes (least recently used evicted first).
+# Flask serves requests on threads, so every lookup/insert holds _parse_cache_lock.
+PARSE_CACHE_SIZE = 8
+_parse_cache = OrderedDict()
+_parse_cache_lock = threading.Lock()
+
+def iter_edges(path):
+    """Stream <edge> elements from a SUMO emissions XML, freeing each once processed."""
+    for _, edge in etree.iterparse(path, tag="edge"):
+        yield edge
+        edge.clear()
+        while edge.getprevious() is not None:
+            del edge.getparent()[0]
+
+def parse_lane_emissions(data):
+    """
+    Per-lane lengths L (n_lanes,) and normed emissions (n_lanes, n_pollutants) [g/km/h]
+    from an uploaded emissions XML. Lanes without length info are skipped.
+    Repeated uploads of the same bytes are served from the cache.
+    """
+    key = hashlib.sha1(data).hexdigest()
+    with _parse_cache_lock:
+        if key in _parse_cache:
+            _parse_cache.move_to_end(key)
+            return _parse_cache[key]
+
+    lengths = []
+    normed = []
+    for edge in iter_edges(io.BytesIO(data)):
+        for lane in edge.iterfind("lane"):
+            # Extract lane length L (if not directly in XML, replace with known mapping)
+            L = float(lane.get("length", 0))  # [m] :contentReference[oaicite:14]{index=14}
+            if L <= 0:
+                continue  # Skip lanes without length info
+            lengths.append(L)
+            normed.append([float(lane.get(f"{pollutant}_normed", 0)) for pollutant in POLLUTANTS])  # [g/km/h] :contentReference[oaicite:15]{index=15}
+
+    parsed = (np.array(lengths), np.array(normed).reshape(-1, len(POLLUTANTS)))
+    # Parsing runs outside the lock; two threads parsing the same upload just store equal results
+    with _parse_cache_lock:
+        _parse_cache[key] = parsed
+        _parse_cache.move_to_end(key)
+        if len(_parse_cache) > PARSE_CACHE_SIZE:
+            _parse_cache.popitem(last=False)
+    return parsed
+
 @app.route("/compute", methods=["POST"])
 def compute_screening():
     """
@@ -27,53 +77,29 @@ def compute_screening():
     if not file:
         return jsonify({"error": "No emissions file provided."}), 400
 
-    # Parse XML
-    tree = ET.parse(file)
-    root = tree.getroot()
-
-    # Initialize total emission rates per pollutant (kg/s)
-    total_emissions = {pollutant: 0.0 for pollutant in POLLUTANTS}
-
-    # Loop through each 'interval' → 'edge' → 'lane' structure
-    for interval in root.findall("interval"):
-        for edge in interval.findall("edge"):
-            for lane in edge.findall("lane"):
-                # Extract lane length L (if not directly in XML, replace with known mapping)
-                L = float(lane.get("length", 0))  # [m] :contentReference[oaicite:14]{index=14}
-                if L <= 0:
-                    continue  # Skip lanes without length info
-
-                # Number of segments (must match frontend logic if needed)
-                N_seg = 10
-
-                # For each pollutant, convert and accumulate Q
-                for pollutant in POLLUTANTS:
-                    E_normed = float(lane.get(f"{pollutant}_normed", 0))  # [g/km/h] :contentReference[oaicite:15]{index=15}
-                    # Convert to kg/s per meter
-                    emission_per_m = E_normed * 1e-6 / 3600  # :contentReference[oaicite:16]{index=16}
-                    # Each segment length Δx
-                    delta_x = L / N_seg
-                    # Emission from the segment (kg/s)
-                    Q_seg = emission_per_m * delta_x  # :contentReference[oaicite:17]{index=17}
-                    # Add to total for pollutant
-                    total_emissions[pollutant] += Q_seg * N_seg  # Summing across all segments :contentReference[oaicite:18]{index=18}
-
-    # Compute screening concentrations
-    results = {}
-    for pollutant, Q in total_emissions.items():
-        # Cloud width: W_wc = 0.1 * x for conservative lateral spread :contentReference[oaicite:19]{index=19}
-        W_wc = 0.1 * x
-        # Gross screening formula: C_wc [µg/m³]
-        if U_wc * H_wc * W_wc > 0:
-            C_wc = (10.0 * Q) / (U_wc * H_wc * W_wc)  # :contentReference[oaicite:20]{index=20}
-            C_wc *= 1e6  # Convert from kg/m³ to µg/m³ (1 kg/m³ = 1e9 µg/m³; factor 10 already accounted) :contentReference[oaicite:21]{index=21}
-        else:
-            C_wc = 0.0
-
-        results[pollutant] = {
-            "Q_kg_per_s": Q,
-            "C_wc_ug_per_m3": C_wc
+    # Per-lane lengths and normed emissions (cached per upload)
+    lane_lengths, lane_normed = parse_lane_emissions(file.read())
+
+    # Total emission rate per pollutant (kg/s): Σ over lanes of E_normed [g/km/h → kg/s per meter] · L.
+    # Splitting a lane into N_seg segments of Δx = L / N_seg and summing Q_seg gives the same total.
+    total_emissions = (lane_lengths @ lane_normed) * (1e-6 / 3600)  # :contentReference[oaicite:16]{index=16}
+
+    # Cloud width: W_wc = 0.1 * x for conservative lateral spread :contentReference[oaicite:19]{index=19}
+    W_wc = 0.1 * x
+    # Gross screening formula for all pollutants at once: C_wc [µg/m³]
+    if U_wc * H_wc * W_wc > 0:
+        C_wc = (10.0 * total_emissions) / (U_wc * H_wc * W_wc)  # :contentReference[oaicite:20]{index=20}
+        C_wc *= 1e6  # Convert from kg/m³ to µg/m³ (1 kg/m³ = 1e9 µg/m³; factor 10 already accounted) :contentReference[oaicite:21]{index=21}
+    else:
+        C_wc = np.zeros(len(POLLUTANTS))
+
+    results = {
+        pollutant: {
+            "Q_kg_per_s": float(Q),
+            "C_wc_ug_per_m3": float(C)
         }
+        for pollutant, Q, C in zip(POLLUTANTS, total_emissions, C_wc)
+    }
 
     return jsonify(results)
 
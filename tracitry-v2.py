@@ -1,7 +1,8 @@
 import traci
 import sumolib
 import csv
-from shapely.geometry import Point, Polygon
+import numpy as np
+from numba import njit, prange
 import xml.etree.ElementTree as ET
 
 # === CONFIGURATION ===
@@ -16,10 +17,31 @@ STEP_LENGTH = 1.0  # simulation step size in seconds
 # === LOAD NETWORK ===
 net = sumolib.net.readNet(NET_FILE)
 junction = net.getNode(JUNCTION_ID)
-junction_polygon = Polygon(junction.getShape())
-
-def is_inside_junction(x, y):
-    return junction_polygon.contains(Point(x, y))
+# Junction polygon vertices, extracted once
+junction_x, junction_y = np.asarray(junction.getShape(), dtype=np.float64).T.copy()
+junction_bbox = np.array([junction_x.min(), junction_y.min(), junction_x.max(), junction_y.max()])
+
+# Helper: batched point-in-polygon (even-odd ray casting)
+@njit(parallel=True, cache=True)
+def points_in_poly(xs, ys, px, py, bbox):
+    """True where (xs[k], ys[k]) lies inside the polygon with vertices (px, py) and bounds bbox."""
+    n = px.shape[0]
+    inside = np.zeros(xs.shape[0], dtype=np.bool_)
+    for k in prange(xs.shape[0]):
+        x = xs[k]
+        y = ys[k]
+        # Most vehicles are nowhere near the junction: four comparisons reject them
+        if x < bbox[0] or y < bbox[1] or x > bbox[2] or y > bbox[3]:
+            continue
+        crossings = False
+        j = n - 1
+        for i in range(n):
+            # Edge (j, i) straddles the horizontal through y and crosses it right of x
+            if (py[i] > y) != (py[j] > y) and x < (px[j] - px[i]) * (y - py[i]) / (py[j] - py[i]) + px[i]:
+                crossings = not crossings
+            j = i
+        inside[k] = crossings
+    return inside
 
 # === START SUMO ===
 sumoCmd = [
@@ -37,10 +59,14 @@ step = 0
 while traci.simulation.getMinExpectedNumber() > 0:
     traci.simulationStep()
 
-    for veh_id in traci.vehicle.getIDList():
-        x, y = traci.vehicle.getPosition(veh_id)
-        inside = is_inside_junction(x, y)
+    # Test every vehicle against the junction polygon in one compiled call
+    veh_ids = traci.vehicle.getIDList()
+    positions = [traci.vehicle.getPosition(veh_id) for veh_id in veh_ids]
+    xs = np.fromiter((p[0] for p in positions), dtype=np.float64, count=len(positions))
+    ys = np.fromiter((p[1] for p in positions), dtype=np.float64, count=len(positions))
+    inside_mask = points_in_poly(xs, ys, junction_x, junction_y, junction_bbox)
 
+    for veh_id, inside in zip(veh_ids, inside_mask):
         if inside:
             if veh_id not in vehicle_times:
                 vtype = traci.vehicle.getTypeID(veh_id)
@@ -55,15 +81,18 @@ while traci.simulation.getMinExpectedNumber() > 0:
 
 traci.close()
 
-# === PARSE TRIPINFO FILE FOR DEPART/ARRIVAL TIMES ===
+# === PARSE TRIPINFO FILE FOR DEPART/ARRIVAL TIMES AND TRIP DURATIONS (one pass) ===
+trip_durations = []
 try:
     tree = ET.parse(TRIPINFO_FILE)
     root = tree.getroot()
-    for trip in root.findall("tripinfo"):
-        veh_id = trip.attrib["id"]
+    for trip in root.iter("tripinfo"):
+        attrs = trip.attrib
+        veh_id = attrs["id"]
         if veh_id in vehicle_times:
-            vehicle_times[veh_id]['depart'] = float(trip.attrib.get("depart", 0.0))
-            vehicle_times[veh_id]['arrival'] = float(trip.attrib.get("arrival", 0.0))
+            vehicle_times[veh_id]['depart'] = float(attrs.get("depart", 0.0))
+            vehicle_times[veh_id]['arrival'] = float(attrs.get("arrival", 0.0))
+        trip_durations.append(float(attrs.get("duration", 0.0)))
 except FileNotFoundError:
     print(f"Warning: tripinfo file not found: {TRIPINFO_FILE}")
 
@@ -87,16 +116,11 @@ durations = [
     if 'enter' in data and 'exit' in data
 ]
 
-avg_junction_time = sum(durations) / len(durations) if durations else 0.0
+avg_junction_time = float(np.mean(durations)) if durations else 0.0
 print(f"Average time inside junction ({JUNCTION_ID}): {avg_junction_time:.2f} seconds")
 
 # === COMPUTE AVERAGE TOTAL TRIP TIME FROM TRIPINFO ===
-trip_durations = [
-    float(trip.attrib.get("duration", 0.0))
-    for trip in root.findall("tripinfo")
-] if root is not None else []
-
-avg_trip_duration = sum(trip_durations) / len(trip_durations) if trip_durations else 0.0
+avg_trip_duration = float(np.mean(trip_durations)) if trip_durations else 0.0
 print(f"Average total trip time: {avg_trip_duration:.2f} seconds")
 
 # === WRITE SUMMARY CSV ===
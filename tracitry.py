@@ -1,7 +1,9 @@
 import traci
+import traci.constants as tc
 import sumolib
 import csv
-from shapely.geometry import Point, Polygon
+import numpy as np
+from numba import njit, prange
 import xml.etree.ElementTree as ET
 
 # === CONFIGURATION ===
@@ -12,14 +14,40 @@ OUTPUT_CSV = "junction_times.csv"
 SUMMARY_CSV = "junction_summary.csv"
 TRIPINFO_FILE = "tripinfo-traci.xml"
 STEP_LENGTH = 1.0  # simulation step size in seconds
+CSV_BUFFER_SIZE = 1 << 20  # 1 MB write buffer for CSV output
+CONTEXT_MARGIN = 50.0  # m beyond the junction shape still reported, so a leaving vehicle is seen outside it
 
 # === LOAD NETWORK ===
 net = sumolib.net.readNet(NET_FILE)
 junction = net.getNode(JUNCTION_ID)
-junction_polygon = Polygon(junction.getShape())
-
-def is_inside_junction(x, y):
-    return junction_polygon.contains(Point(x, y))
+# Junction polygon vertices, extracted once
+junction_x, junction_y = np.asarray(junction.getShape(), dtype=np.float64).T.copy()
+junction_bbox = np.array([junction_x.min(), junction_y.min(), junction_x.max(), junction_y.max()])
+# Radius around the junction centre for the context subscription: covers the whole shape plus margin
+junction_cx, junction_cy = junction.getCoord()
+context_radius = float(np.hypot(junction_x - junction_cx, junction_y - junction_cy).max()) + CONTEXT_MARGIN
+
+# Helper: batched point-in-polygon (even-odd ray casting)
+@njit(parallel=True, cache=True)
+def points_in_poly(xs, ys, px, py, bbox):
+    """True where (xs[k], ys[k]) lies inside the polygon with vertices (px, py) and bounds bbox."""
+    n = px.shape[0]
+    inside = np.zeros(xs.shape[0], dtype=np.bool_)
+    for k in prange(xs.shape[0]):
+        x = xs[k]
+        y = ys[k]
+        # Most vehicles are nowhere near the junction: four comparisons reject them
+        if x < bbox[0] or y < bbox[1] or x > bbox[2] or y > bbox[3]:
+            continue
+        crossings = False
+        j = n - 1
+        for i in range(n):
+            # Edge (j, i) straddles the horizontal through y and crosses it right of x
+            if (py[i] > y) != (py[j] > y) and x < (px[j] - px[i]) * (y - py[i]) / (py[j] - py[i]) + px[i]:
+                crossings = not crossings
+            j = i
+        inside[k] = crossings
+    return inside
 
 # === START SUMO ===
 sumoCmd = [
@@ -31,42 +59,66 @@ sumoCmd = [
 ]
 traci.start(sumoCmd)
 
-vehicle_times = {}  # Dictionary to track entry/exit times and vehicle type
-step = 0
-
-while traci.simulation.getMinExpectedNumber() > 0:
-    traci.simulationStep()
-
-    for veh_id in traci.vehicle.getIDList():
-        x, y = traci.vehicle.getPosition(veh_id)
-        inside = is_inside_junction(x, y)
-
-        if inside:
-            if veh_id not in vehicle_times:
-                vtype = traci.vehicle.getTypeID(veh_id)
-                vehicle_times[veh_id] = {
-                    'enter': step * STEP_LENGTH,
-                    'vtype': vtype
-                }
-        elif veh_id in vehicle_times and 'exit' not in vehicle_times[veh_id]:
-            vehicle_times[veh_id]['exit'] = step * STEP_LENGTH
-
-    step += 1
-
+# One context subscription on the junction: every step SUMO returns position and type of all
+# vehicles within context_radius in a single message, instead of one call per vehicle
+traci.junction.subscribeContext(JUNCTION_ID, tc.CMD_GET_VEHICLE_VARIABLE, context_radius, [tc.VAR_POSITION, tc.VAR_TYPE])
+
+# === SIMULATION LOOP ===
+def run_sim():
+    # Everything the loop touches is bound to a local once, so each step does fast local
+    # lookups instead of repeated global and attribute lookups
+    vehicle_times = {}  # Dictionary to track entry/exit times and vehicle type
+    step_length = STEP_LENGTH
+    position = tc.VAR_POSITION
+    vtype_var = tc.VAR_TYPE
+    junction_id = JUNCTION_ID
+    min_expected = traci.simulation.getMinExpectedNumber
+    simulation_step = traci.simulationStep
+    get_nearby = traci.junction.getContextSubscriptionResults
+    contains = points_in_poly
+    px, py, bbox = junction_x, junction_y, junction_bbox
+    float64 = np.float64
+    step = 0
+
+    while min_expected() > 0:
+        simulation_step()
+
+        # Vehicles near the junction only; the rest of the network is never transferred
+        nearby = get_nearby(junction_id) or {}
+
+        # Test every vehicle against the junction polygon in one compiled call
+        veh_ids = list(nearby)
+        xs = np.fromiter((sub[position][0] for sub in nearby.values()), dtype=float64, count=len(veh_ids))
+        ys = np.fromiter((sub[position][1] for sub in nearby.values()), dtype=float64, count=len(veh_ids))
+        inside_mask = contains(xs, ys, px, py, bbox)
+
+        now = step * step_length
+        for veh_id, inside in zip(veh_ids, inside_mask):
+            if inside:
+                if veh_id not in vehicle_times:
+                    vehicle_times[veh_id] = {
+                        'enter': now,
+                        'vtype': nearby[veh_id][vtype_var]
+                    }
+            elif veh_id in vehicle_times and 'exit' not in vehicle_times[veh_id]:
+                vehicle_times[veh_id]['exit'] = now
+
+        step += 1
+
+    return vehicle_times
+
+vehicle_times = run_sim()
 traci.close()
 
 # === WRITE PER-VEHICLE CSV ===
-with open(OUTPUT_CSV, mode="w", newline="") as csvfile:
+with open(OUTPUT_CSV, mode="w", newline="", buffering=CSV_BUFFER_SIZE) as csvfile:
     writer = csv.writer(csvfile)
     writer.writerow(["vehicle_id", "vtype",  "depart_time_s", "junction_entry_time_s", "junction_exit_time_s", "arrival_time_s"])
-    for veh_id, data in vehicle_times.items():
-        depart = data.get('depart', "")
-        entry = data.get('enter')
-        exit_ = data.get('exit')
-        vtype = data.get('vtype', "unknown")
-        arrival = data.get('arrival', "")
-        if entry is not None and exit_ is not None:
-            writer.writerow([veh_id, vtype, depart, entry, exit_, arrival])
+    writer.writerows(
+        (veh_id, data.get('vtype', "unknown"), data.get('depart', ""), data['enter'], data['exit'], data.get('arrival', ""))
+        for veh_id, data in vehicle_times.items()
+        if data.get('enter') is not None and data.get('exit') is not None
+    )
 
 # === COMPUTE AVERAGE TIME INSIDE JUNCTION ===
 durations = [
@@ -75,7 +127,7 @@ durations = [
     if 'enter' in data and 'exit' in data
 ]
 
-avg_junction_time = sum(durations) / len(durations) if durations else 0.0
+avg_junction_time = float(np.mean(durations)) if durations else 0.0
 print(f"Average time inside junction ({JUNCTION_ID}): {avg_junction_time:.2f} seconds")
 
 # === COMPUTE AVERAGE TOTAL TRIP TIME FROM TRIPINFO ===
@@ -83,17 +135,17 @@ trip_durations = []
 try:
     tree = ET.parse(TRIPINFO_FILE)
     root = tree.getroot()
-    for trip in root.findall("tripinfo"):
+    for trip in root.iter("tripinfo"):
         duration = float(trip.attrib.get("duration", 0.0))
         trip_durations.append(duration)
 except FileNotFoundError:
     print(f"Warning: tripinfo file not found: {TRIPINFO_FILE}")
 
-avg_trip_duration = sum(trip_durations) / len(trip_durations) if trip_durations else 0.0
+avg_trip_duration = float(np.mean(trip_durations)) if trip_durations else 0.0
 print(f"Average total trip time: {avg_trip_duration:.2f} seconds")
 
 # === OPTIONAL: WRITE SUMMARY CSV ===
-with open(SUMMARY_CSV, "w", newline="") as summary_file:
+with open(SUMMARY_CSV, "w", newline="", buffering=CSV_BUFFER_SIZE) as summary_file:
     writer = csv.writer(summary_file)
     writer.writerow(["junction_id", "vehicles_in_junction", "avg_time_in_junction_s", "avg_total_trip_time_s"])
     writer.writerow([JUNCTION_ID, len(durations), f"{avg_junction_time:.2f}", f"{avg_trip_duration:.2f}"])
@@ -1,8 +1,10 @@
 import csv
-import xml.etree.ElementTree as ET
-from xml.etree.ElementTree import Element, SubElement, ElementTree
-from datetime import datetime, timedelta
+from datetime import timedelta
 import random
+import heapq
+from collections import defaultdict
+from lxml import etree
+import numpy as np
 
 # === CONFIGURATION ===
 CAMERA_CSV = "traffic_flow_may_17.csv"
@@ -29,18 +31,23 @@ DIRECTION_TO_EDGE_OUT = {
 VEHICLE_WHITELIST = {"car", "motorcycle", "truck", "bus"}
 
 # === LOAD SPEED AND EDGE LENGTH DATA ===
+def iter_elements(path, tag):
+    """Stream <tag> elements from an XML file, freeing each once processed."""
+    for _, elem in etree.iterparse(path, tag=tag):
+        yield elem
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+
 def load_speeds_from_vtypes(vtypes_file):
-    tree = ET.parse(vtypes_file)
-    root = tree.getroot()
     return {
         v.attrib["id"]: float(v.attrib.get("maxSpeed", v.attrib.get("speed", 13.89)))
-        for v in root.iter("vType")
+        for v in iter_elements(vtypes_file, "vType")
     }
 
 def load_edge_lengths(net_file):
-    tree = ET.parse(net_file)
     edge_map = {}
-    for edge in tree.findall("edge"):
+    for edge in iter_elements(net_file, "edge"):
         if edge.get("function") == "internal":
             continue
         for lane in edge.findall("lane"):
@@ -55,16 +62,6 @@ def estimate_depart(junction_time, from_edge, vtype):
     speed = SPEED_LOOKUP.get(vtype, 13.89)
     return round(junction_time - (length / speed))
 
-def parse_iso_with_nanos(iso_str):
-    if not iso_str:
-        return None
-    if '.' in iso_str:
-        base, frac = iso_str.split('.')
-        frac = frac.rstrip('Z')
-        frac = (frac + "000000")[:6]
-        iso_str = f"{base}.{frac}Z"
-    return datetime.strptime(iso_str, "%Y-%m-%dT%H:%M:%S.%fZ")
-
 def validate_camera_headers(headers):
     required = {"entered_time", "exit_time", "direction_entry", "vehicle_id","direction_exit", "vehicle_type_entry", "vehicle_type_exit"}
     missing = required - set(h.strip().lower() for h in headers)
@@ -77,14 +74,22 @@ def validate_manual_headers(headers):
     if missing:
         raise ValueError(f"[ERROR] Manual count CSV is missing required headers: {missing}")
 
+def build_normalizer(rows, columns, normalize):
+    # Normalize every distinct value of the given CSV columns once: raw string -> normalized
+    return {raw: normalize(raw) for raw in {row.get(c) for row in rows for c in columns} if raw is not None}
+
 def parse_time_to_seconds(time_str):
-    dt = datetime.strptime(time_str.strip(), "%H:%M")
-    return dt.hour * 3600 + dt.minute * 60
+    # "H:MM" / "HH:MM" sliced by hand, strptime is the slow part of the row loop
+    hours, minutes = time_str.strip().split(":")
+    hours, minutes = int(hours), int(minutes)
+    if not (0 <= hours < 24 and 0 <= minutes < 60):
+        raise ValueError(f"time data {time_str!r} is out of range")
+    return hours * 3600 + minutes * 60
 
 
 # === STEP 1: PARSE CAMERA DATA ===
 print("[INFO] Processing camera CSV...")
-camera_keys = {}
+camera_keys = defaultdict(int)
 camera_trips = []
 midnight = None
 
@@ -92,63 +97,79 @@ with open(CAMERA_CSV) as f:
     
     reader = csv.DictReader(f)
     validate_camera_headers(reader.fieldnames)
-    for row in reader:
-        entry_dir = row["direction_entry"].strip().lower()
-        exit_dir = row["direction_exit"].strip().lower()
+    rows = list(reader)
+    direction_norm = build_normalizer(rows, ("direction_entry", "direction_exit"), lambda s: s.strip().lower())
+    vtype_norm = build_normalizer(rows, ("vehicle_type_entry", "vehicle_type_exit"), str.strip)
+
+    # Every timestamp parsed in one numpy pass ("...T..:..:..[.fffffffff]Z", fraction truncated to
+    # microseconds), entered_time falling back to exit_time, shifted to PH time; empty -> NaT
+    stamps = np.array(
+        [(row["entered_time"].strip() or row["exit_time"].strip()).rstrip("Z") for row in rows],
+        dtype="datetime64[us]",
+    ) + np.timedelta64(PH_TZ_OFFSET)
+    missing_stamp = np.isnat(stamps)
+
+    kept = []  # (row index, entry_dir, exit_dir, vtype, from_edge, to_edge) of rows that make trips
+    for k, row in enumerate(rows):
+        entry_dir = direction_norm[row["direction_entry"]]
+        exit_dir = direction_norm[row["direction_exit"]]
 
         if not entry_dir:
             entry_dir = random.choice(list(DIRECTION_TO_EDGE_IN))
         if not exit_dir or exit_dir == entry_dir:
             exit_dir = random.choice([d for d in DIRECTION_TO_EDGE_OUT if d != entry_dir])
 
-        vtype = row["vehicle_type_entry"].strip() or row["vehicle_type_exit"].strip()
+        vtype = vtype_norm[row["vehicle_type_entry"]] or vtype_norm[row["vehicle_type_exit"]]
         if vtype not in VEHICLE_WHITELIST:
             continue
 
         from_edge = DIRECTION_TO_EDGE_IN[entry_dir]
         to_edge = DIRECTION_TO_EDGE_OUT[exit_dir]
 
-        timestamp_str = row["entered_time"].strip() or row["exit_time"].strip()
-        dt = parse_iso_with_nanos(timestamp_str)
-        if dt is None:
+        if missing_stamp[k]:
             print(f"[WARN] Skipping row with missing timestamp: {row}")
             continue
-        dt += PH_TZ_OFFSET
+        kept.append((k, entry_dir, exit_dir, vtype, from_edge, to_edge))
 
-        if midnight is None:
-            midnight = dt.replace(hour=0, minute=0, second=0, microsecond=0)
+if kept:
+    # Seconds since midnight (PH) of the first kept row's day, again as one array operation
+    day_start = stamps[kept[0][0]].astype("datetime64[D]").astype("datetime64[us]")
+    midnight = day_start.item()
+    seconds_since_midnight = (stamps[[k for k, *_ in kept]] - day_start) / np.timedelta64(1, "s")
 
-        seconds = (dt - midnight).total_seconds()
+    for (_, entry_dir, exit_dir, vtype, from_edge, to_edge), seconds in zip(kept, seconds_since_midnight.tolist()):
         depart = estimate_depart(seconds, from_edge, vtype)
         minute = int(seconds) // 60
 
         key = (minute, entry_dir, exit_dir, vtype)
-        camera_keys[key] = camera_keys.get(key, 0) + 1
+        camera_keys[key] += 1
         camera_trips.append((depart, vtype, from_edge, to_edge))
 
 # === STEP 2: LOAD MANUAL COUNTS ===
 print("[INFO] Processing manual counts...")
-manual_counts = {}
+manual_counts = defaultdict(int)
 
 with open(MANUAL_CSV) as f:
     reader = csv.DictReader(f)
     validate_manual_headers(reader.fieldnames)
-    for row in reader:
+    rows = list(reader)
+    manual_norm = build_normalizer(rows, ("vehicle", "entry", "exit"), lambda s: s.strip().lower())
+    for row in rows:
         try:
-            dt = datetime.strptime(row["time"], "%Y-%m-%d %H:%M:%S")
-            minute = (dt - dt.replace(hour=0, minute=0, second=0)).total_seconds() // 60
-            minute = int(minute)
+            # "YYYY-MM-DD HH:MM:SS" -> minute of the day
+            time_str = row["time"]
+            minute = int(time_str[11:13]) * 60 + int(time_str[14:16])
 
-            vtype = row["vehicle"].strip().lower()
-            entry = row["entry"].strip().lower()
-            exit_ = row["exit"].strip().lower()
+            vtype = manual_norm[row["vehicle"]]
+            entry = manual_norm[row["entry"]]
+            exit_ = manual_norm[row["exit"]]
 
             if vtype not in VEHICLE_WHITELIST:
                 print(f"[WARN] Skipping due to vehicle type '{vtype}' not in whitelist.")
                 continue
 
             key = (minute, entry, exit_, vtype)
-            manual_counts[key] = manual_counts.get(key, 0) + 1
+            manual_counts[key] += 1
         except Exception as e:
             print(f"[WARN] Skipping manual row: {e}")
 
@@ -176,19 +197,17 @@ for key, manual_count in manual_counts.items():
 
 # === STEP 4: COMBINE AND EXPORT ===
 print("[INFO] Writing to XML...")
-all_trips = camera_trips + supplemental_trips
-all_trips.sort()
-
-trips_elem = Element("trips")
+# Sort each source on its own and merge, instead of sorting a concatenated copy of both
+camera_trips.sort()
+supplemental_trips.sort()
+all_trips = heapq.merge(camera_trips, supplemental_trips)
 
+# Attribute values are whitelisted vtypes, edge ids and ints, so no XML escaping is needed
+parts = ['<?xml version="1.0" encoding="utf-8"?>\n<trips>\n']
 for i, (depart, vtype, from_edge, to_edge) in enumerate(all_trips):
-    SubElement(trips_elem, "trip", {
-        "id": f"{vtype}_{i}",
-        "type": vtype,
-        "depart": str(depart),
-        "from": from_edge,
-        "to": to_edge
-    })
-
-ElementTree(trips_elem).write(OUTPUT_XML, encoding="utf-8", xml_declaration=True)
-print(f"[DONE] Wrote {len(all_trips)} total trips to {OUTPUT_XML}")
+    parts.append(f'    <trip id="{vtype}_{i}" type="{vtype}" depart="{depart}" from="{from_edge}" to="{to_edge}"/>\n')
+parts.append("</trips>\n")
+
+with open(OUTPUT_XML, "w", encoding="utf-8") as f:
+    f.write("".join(parts))
+print(f"[DONE] Wrote {len(parts) - 2} total trips to {OUTPUT_XML}")
@@ -1,10 +1,9 @@
 import csv
 from datetime import datetime, timedelta
 from xml.etree.ElementTree import Element, SubElement, ElementTree
-import xml.etree.ElementTree as ET
 import random
-from collections import defaultdict
 from xml.etree.ElementTree import parse
+from lxml import etree
 
 PH_TZ_OFFSET = timedelta(hours=8)
 
@@ -30,12 +29,19 @@ DIRECTION_TO_EDGE_OUT = {
     "west": "-4922743#4"
 }
 
+# === Streaming XML helper ===
+def iter_elements(path, tag):
+    """Stream <tag> elements from an XML file, freeing each once processed."""
+    for _, elem in etree.iterparse(path, tag=tag):
+        yield elem
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+
 # === Load vehicle types and speeds ===
 def load_speeds_from_vtypes(vtypes_file):
-    tree = ET.parse(vtypes_file)
-    root = tree.getroot()
     speed_map = {}
-    for vtype in root.iter("vType"):
+    for vtype in iter_elements(vtypes_file, "vType"):
         vtype_id = vtype.attrib["id"]
         speed = float(vtype.attrib.get("maxSpeed", vtype.attrib.get("speed", "13.89")))
         speed_map[vtype_id] = speed
@@ -46,8 +52,7 @@ SPEED_LOOKUP = load_speeds_from_vtypes(VTYPES_XML)
 # === Load edge lengths ===
 def load_edge_lengths(net_file):
     edge_map = {}
-    tree = ET.parse(net_file)
-    for edge in tree.findall("edge"):
+    for edge in iter_elements(net_file, "edge"):
         if "function" in edge.attrib and edge.attrib["function"] == "internal":
             continue
         for lane in edge.findall("lane"):
@@ -67,22 +72,26 @@ def estimate_depart(junction_time, from_edge, vtype):
 
 def parse_iso_with_nanos(iso_str):
     # Supports ISO format with or without fractional seconds, strips trailing 'Z'
-    if '.' in iso_str:
-        base, frac = iso_str.split('.')
-        frac = frac.rstrip('Z')
-        frac = (frac + "000000")[:6]  # microseconds padded or truncated to 6 digits
-        iso_str = f"{base}.{frac}Z"
-    return datetime.strptime(iso_str, "%Y-%m-%dT%H:%M:%S.%fZ")
+    # Sliced by hand instead of strptime, fraction padded or truncated to microseconds
+    base, _, frac = iso_str.rstrip('Z').partition('.')
+    return datetime(int(base[0:4]), int(base[5:7]), int(base[8:10]),
+                    int(base[11:13]), int(base[14:16]), int(base[17:19]), int((frac + "000000")[:6]))
 
 def parse_time_to_seconds(time_str):
-    dt = datetime.strptime(time_str.strip(), "%H:%M")
-    return dt.hour * 3600 + dt.minute * 60
+    # "H:MM" / "HH:MM" sliced by hand, strptime is the slow part of the row loop
+    hours, minutes = time_str.strip().split(":")
+    hours, minutes = int(hours), int(minutes)
+    if not (0 <= hours < 24 and 0 <= minutes < 60):
+        raise ValueError(f"time data {time_str!r} is out of range")
+    return hours * 3600 + minutes * 60
+
+def build_normalizer(rows, columns, normalize):
+    # Normalize every distinct value of the given CSV columns once: raw string -> normalized
+    return {raw: normalize(raw) for raw in {row.get(c) for row in rows for c in columns} if raw is not None}
 
 def load_existing_vehicle_ids(existing_trips_file):
     existing_ids = set()
-    tree = ET.parse(existing_trips_file)
-    root = tree.getroot()
-    for trip in root.findall("trip"):
+    for trip in iter_elements(existing_trips_file, "trip"):
         trip_id = trip.attrib.get("id")
         if trip_id:
             existing_ids.add(trip_id)
@@ -116,17 +125,23 @@ if header_index == -1:
 
 cleaned_lines = [line for line in lines[header_index:] if line.strip()]
 reader = csv.DictReader(cleaned_lines)
+rows = list(reader)
+
+# Entry/Exit/Vehicle hold a handful of distinct strings: normalize each once, not once per row
+direction_norm = build_normalizer(rows, ("Entry", "Exit"), lambda s: s.strip().lower())
+vtype_norm = build_normalizer(rows, ("Vehicle",), lambda s: s.strip().lower().replace('\xa0', ''))
 
 midnight = None
+depart_pools = {}  # base minute -> shuffled offsets 0-59 not handed out yet, shared by all rows
 
-for row in reader:
+for row in rows:
     try:
         if "Entry" not in row or "Exit" not in row:
             print(f"[WARN] Skipping row due to missing 'Entry' or 'Exit': {row}")
             continue
 
-        entry_dir = row["Entry"].strip().lower()
-        exit_dir = row["Exit"].strip().lower()
+        entry_dir = direction_norm[row["Entry"]]
+        exit_dir = direction_norm[row["Exit"]]
         #print(f"[DEBUG] Entry: {entry_dir}, Exit: {exit_dir}")
 
         # Assign missing directions randomly, ensure entry != exit
@@ -150,7 +165,7 @@ for row in reader:
             continue
 
         # Vehicle type priority: entry type, else exit type
-        vtype = row["Vehicle"].strip().lower().replace('\xa0', '') 
+        vtype = vtype_norm[row["Vehicle"]]
         #print(f"[DEBUG] Vehicle type: {vtype}")
 
 
@@ -181,7 +196,6 @@ for row in reader:
 
         entered_seconds = parse_time_to_seconds(entered_time_str)
         #print(f"[DEBUG] Parsed time: {entered_seconds} seconds")
-        depart_offsets = defaultdict(set)
 
         # Estimate the base departure time
         depart_time = estimate_depart(entered_seconds, from_edge, vtype)
@@ -189,16 +203,16 @@ for row in reader:
         
         # Determine the base minute (i.e., floor to nearest 60)
         base_minute = (depart_time // 60) * 60
-        used_offsets = depart_offsets[base_minute]
+        pool = depart_pools.get(base_minute)
+        if pool is None:
+            pool = depart_pools[base_minute] = random.sample(range(60), 60)
 
-        if len(used_offsets) >= 9:
+        if not pool:
             print(f"[WARN] More than 60 vehicles detected at {base_minute}, skipping row.")
             continue
 
         # Random unused offset between 0 and 59
-        available_offsets = list(set(range(60)) - used_offsets)
-        random_offset = random.choice(available_offsets)
-        depart_offsets[base_minute].add(random_offset)
+        random_offset = pool.pop()
 
         # Final adjusted departure time
         adjusted_depart_time = base_minute + random_offset
@@ -282,11 +296,8 @@ for vehicle_id, (depart, vtype, from_edge, to_edge) in enumerate(parsed_rows):
     countt += 1
 
 # === STEP 2.5: Sort all <trip> elements by depart time ===
-sorted_trips = sorted(trips.findall("trip"), key=lambda t: float(t.attrib["depart"]))
-for trip in list(trips):
-    trips.remove(trip)  # Remove all existing trips
-for trip in sorted_trips:
-    trips.append(trip)  # Re-insert in sorted order
+# One slice assignment replaces the children (only <trip> elements are kept, as before)
+trips[:] = sorted(trips.findall("trip"), key=lambda t: float(t.attrib["depart"]))
 
 
 # === STEP 3: Output to XML ===
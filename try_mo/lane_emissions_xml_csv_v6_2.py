@@ -1,15 +1,15 @@
 import xml.etree.ElementTree as ET
 import csv
 from datetime import timedelta
-from collections import defaultdict
 
 # Input/output files
 INPUT_XML = "lane_emissions-dir.xml"
 OUTPUT_CSV = "lane_emissions_pivoted.csv"
 CONVERSION_FACTOR = 0.27778  # g/km/h → µg/(m·s)
+POLLUTANTS = ["NOx", "CO", "CO2", "PMx", "NO", "NO2", "PM10", "PM2.5", "SO2", "Ozone"]
 
-# Create a nested dictionary: data[(lane_id, pollutant)][interval_str] = value
-data = defaultdict(lambda: defaultdict(float))
+# Flat dictionary: data[(lane_id, interval_str)] = totals in POLLUTANTS order
+data = {}
 
 # Parse XML
 tree = ET.parse(INPUT_XML)
@@ -29,39 +29,32 @@ for interval in root.findall("interval"):
             lane_id = lane.get("id")
 
             # Extract normed values and convert
-            pollutants = {
-                "NOx": float(lane.get("NOx_normed", 0)) * CONVERSION_FACTOR,
-                "CO": float(lane.get("CO_normed", 0)) * CONVERSION_FACTOR,
-                "CO2": float(lane.get("CO2_normed", 0)) * CONVERSION_FACTOR,
-                "PMx": float(lane.get("PMx_normed", 0)) * CONVERSION_FACTOR
-            }
+            nox = float(lane.get("NOx_normed", 0)) * CONVERSION_FACTOR
+            co = float(lane.get("CO_normed", 0)) * CONVERSION_FACTOR
+            co2 = float(lane.get("CO2_normed", 0)) * CONVERSION_FACTOR
+            pmx = float(lane.get("PMx_normed", 0)) * CONVERSION_FACTOR
 
-            # Breakdown calculations
-            breakdown = {
-                "NO": pollutants["NOx"] * 0.75,
-                "NO2": pollutants["NOx"] * 0.25,
-                "PM10": pollutants["PMx"] * 0.6,
-                "PM2.5": pollutants["PMx"] * 0.4,
-                "SO2": 0.0,
-                "Ozone": 0.0
-            }
+            # Combine with the breakdown calculations, in POLLUTANTS order
+            values = (nox, co, co2, pmx, nox * 0.75, nox * 0.25, pmx * 0.6, pmx * 0.4, 0.0, 0.0)
 
-            # Combine all pollutant values
-            all_pollutants = {**pollutants, **breakdown}
+            # One lookup per lane/interval instead of one per pollutant
+            totals = data.setdefault((lane_id, interval_str), [0.0] * len(POLLUTANTS))
+            for i, value in enumerate(values):
+                totals[i] += value
 
-            for pollutant, value in all_pollutants.items():
-                data[(lane_id, pollutant)][interval_str] += value
-
-# Determine all unique time intervals (sorted)
-all_intervals = sorted({k for v in data.values() for k in v})
+# Determine all lanes (in order of first appearance) and unique time intervals (sorted)
+all_lanes = list(dict.fromkeys(lane_id for lane_id, _ in data))
+all_intervals = sorted({interval_str for _, interval_str in data})
 
 # Write pivoted CSV
 with open(OUTPUT_CSV, "w", newline="") as csvfile:
     writer = csv.writer(csvfile)
     writer.writerow(["Lane", "Pollutant"] + all_intervals)
 
-    for (lane, pollutant), interval_values in data.items():
-        row = [lane, pollutant] + [f"{interval_values.get(t, 0):.2f}" for t in all_intervals]
-        writer.writerow(row)
+    for lane in all_lanes:
+        lane_totals = [data.get((lane, t)) for t in all_intervals]
+        for i, pollutant in enumerate(POLLUTANTS):
+            row = [lane, pollutant] + [f"{totals[i] if totals else 0:.2f}" for totals in lane_totals]
+            writer.writerow(row)
 
 print(f"[DONE] Wrote pivoted emissions data to {OUTPUT_CSV}")
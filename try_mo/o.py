@@ -1,7 +1,7 @@
-import csv
-from datetime import datetime, timedelta
-from xml.etree.ElementTree import Element, SubElement, ElementTree
-import xml.etree.ElementTree as ET
+import mmap
+from datetime import timedelta
+from lxml import etree
+import polars as pl
 import random
 
 PH_TZ_OFFSET = timedelta(hours=8)
@@ -28,12 +28,19 @@ DIRECTION_TO_EDGE_OUT = {
     "west": "-4922743#4"
 }
 
+# === Streaming XML helper ===
+def iter_elements(path, tag):
+    """Stream <tag> elements from an XML file, freeing each once processed."""
+    for _, elem in etree.iterparse(path, tag=tag):
+        yield elem
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+
 # === Load vehicle types and speeds ===
 def load_speeds_from_vtypes(vtypes_file):
-    tree = ET.parse(vtypes_file)
-    root = tree.getroot()
     speed_map = {}
-    for vtype in root.iter("vType"):
+    for vtype in iter_elements(vtypes_file, "vType"):
         vtype_id = vtype.attrib["id"]
         speed = float(vtype.attrib.get("maxSpeed", vtype.attrib.get("speed", "13.89")))
         speed_map[vtype_id] = speed
@@ -44,41 +51,35 @@ SPEED_LOOKUP = load_speeds_from_vtypes(VTYPES_XML)
 # === Load edge lengths ===
 def load_edge_lengths(net_file):
     edge_map = {}
-    tree = ET.parse(net_file)
-    for edge in tree.findall("edge"):
-        if "function" in edge.attrib and edge.attrib["function"] == "internal":
+    for edge in iter_elements(net_file, "edge"):
+        if edge.get("function") == "internal":
             continue
-        for lane in edge.findall("lane"):
-            edge_id = edge.attrib["id"]
-            length = float(lane.attrib["length"])
-            edge_map[edge_id] = length
+        # Each lane used to overwrite the previous one, so the last lane's length is the one kept
+        lanes = edge.findall("lane")
+        if lanes:
+            edge_map[edge.get("id")] = float(lanes[-1].get("length"))
     return edge_map
 
 EDGE_LENGTHS = load_edge_lengths(NET_XML)
 
+# Travel time only depends on (entry edge, vehicle type): precompute every mapped combination
+TRAVEL_TIMES = {
+    (edge, vtype): EDGE_LENGTHS.get(edge, 100) / SPEED_LOOKUP.get(vtype, 13.89)
+    for edge in DIRECTION_TO_EDGE_IN.values()
+    for vtype in VEHICLE_WHITELIST
+}
+
 # === Helpers ===
 def estimate_depart(junction_time, from_edge, vtype):
-    length = EDGE_LENGTHS.get(from_edge, 100)
-    speed = SPEED_LOOKUP.get(vtype, 13.89)
-    travel_time = length / speed
+    travel_time = TRAVEL_TIMES.get((from_edge, vtype))
+    if travel_time is None:  # unmapped direction: same defaults as the table
+        travel_time = EDGE_LENGTHS.get(from_edge, 100) / SPEED_LOOKUP.get(vtype, 13.89)
     return round(junction_time - travel_time)
 
-def parse_iso_with_nanos(iso_str):
-    # Supports ISO format with or without fractional seconds, strips trailing 'Z'
-    if '.' in iso_str:
-        base, frac = iso_str.split('.')
-        frac = frac.rstrip('Z')
-        frac = (frac + "000000")[:6]  # microseconds padded or truncated to 6 digits
-        iso_str = f"{base}.{frac}Z"
-    return datetime.strptime(iso_str, "%Y-%m-%dT%H:%M:%S.%fZ")
-
 # === STEP 1: Read CSV and detect header ===
 print("[INFO] Reading CSV with directional fields...")
 parsed_rows = []
 
-with open(INPUT_CSV, newline='') as f:
-    lines = f.readlines()
-
 header_index = -1
 required_headers = [
     "direction_entry",
@@ -90,19 +91,41 @@ required_headers = [
     "vehicle_type_exit"
 ]
 
-for i, line in enumerate(lines):
-    if all(h in line for h in required_headers):
-        print(f"[INFO] Header found at line {i}: {line.strip()}")
-        header_index = i
-        break
+# Scan only up to the header line through a memory map instead of reading the whole file
+with open(INPUT_CSV, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+    for i, raw_line in enumerate(iter(buf.readline, b"")):
+        line = raw_line.decode("utf-8", errors="replace")
+        if all(h in line for h in required_headers):
+            print(f"[INFO] Header found at line {i}: {line.strip()}")
+            header_index = i
+            break
 
 if header_index == -1:
     raise ValueError("[ERROR] No valid header found matching new column names.")
 
-reader = csv.DictReader(lines[header_index:])
+# Parse the data rows in one native pass, everything kept as strings like csv.DictReader:
+# blank lines are skipped and empty fields read as ""
+df = pl.read_csv(
+    INPUT_CSV,
+    skip_rows=header_index,
+    columns=required_headers,
+    infer_schema=False,
+)
+df = df.filter(~pl.all_horizontal(pl.all().is_null())).fill_null("")
+
+# ISO timestamps (fraction truncated to microseconds, trailing 'Z') parsed for all rows at once;
+# entered_time falls back to exit_time, unparseable values become null
+entered = pl.col("entered_time").str.strip_chars()
+df = df.with_columns(
+    (
+        pl.when(entered == "").then(pl.col("exit_time").str.strip_chars()).otherwise(entered)
+        .str.to_datetime("%Y-%m-%dT%H:%M:%S%.fZ", time_unit="us", strict=False)
+        + PH_TZ_OFFSET
+    ).alias("entered_dt_ph")
+)
 midnight = None
 
-for row in reader:
+for row in df.iter_rows(named=True):
     try:
         entry_dir = row["direction_entry"].strip().lower()
         exit_dir = row["direction_exit"].strip().lower()
@@ -135,9 +158,9 @@ for row in reader:
             entered_time_str = row["exit_time"].strip()
             print(f"[WARN] Missing entered_time, using exit_time: {entered_time_str}")
 
-
-        entered_dt_utc = parse_iso_with_nanos(entered_time_str)
-        entered_dt_ph = entered_dt_utc + PH_TZ_OFFSET
+        entered_dt_ph = row["entered_dt_ph"]
+        if entered_dt_ph is None:
+            raise ValueError(f"unparseable timestamp '{entered_time_str}'")
 
         if midnight is None:
             midnight = entered_dt_ph.replace(hour=0, minute=0, second=0, microsecond=0)
@@ -156,18 +179,14 @@ if not parsed_rows:
 # === STEP 2: Generate trips ===
 print("[INFO] Generating trips from direction-based input...")
 parsed_rows.sort()
-trips = Element("trips")
 
+# Attribute values are whitelisted vtypes, edge ids and ints, so no XML escaping is needed
+parts = ["<?xml version='1.0' encoding='utf-8'?>\n<trips>"]
 for vehicle_id, (depart, vtype, from_edge, to_edge) in enumerate(parsed_rows):
-    SubElement(trips, "trip", {
-        "id": f"{vtype}_{vehicle_id}",
-        "type": vtype,
-        "depart": str(depart),
-        "from": from_edge,
-        "to": to_edge
-    })
+    parts.append(f'<trip id="{vtype}_{vehicle_id}" type="{vtype}" depart="{depart}" from="{from_edge}" to="{to_edge}" />')
+parts.append("</trips>")
 
 # === STEP 3: Output to XML ===
-tree = ElementTree(trips)
-tree.write(OUTPUT_TRIPS, encoding="utf-8", xml_declaration=True)
+with open(OUTPUT_TRIPS, "w", encoding="utf-8") as f:
+    f.write("".join(parts))
 print(f"[DONE] Wrote {vehicle_id + 1} trips to {OUTPUT_TRIPS}")
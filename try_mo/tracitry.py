@@ -1,7 +1,8 @@
 import traci
 import sumolib
 import csv
-from shapely.geometry import Point, Polygon
+import numpy as np
+from numba import njit, prange
 
 # === CONFIGURATION ===
 NET_FILE = "smaller.net.xml"
@@ -13,10 +14,31 @@ STEP_LENGTH = 1.0  # simulation step size in seconds
 # === LOAD NETWORK ===
 net = sumolib.net.readNet(NET_FILE)
 junction = net.getNode(JUNCTION_ID)
-junction_polygon = Polygon(junction.getShape())
+# Junction polygon vertices, extracted once
+junction_x, junction_y = np.asarray(junction.getShape(), dtype=np.float64).T.copy()
+junction_bbox = np.array([junction_x.min(), junction_y.min(), junction_x.max(), junction_y.max()])
 
-def is_inside_junction(x, y):
-    return junction_polygon.contains(Point(x, y))
+# Helper: batched point-in-polygon (even-odd ray casting)
+@njit(parallel=True, cache=True)
+def points_in_poly(xs, ys, px, py, bbox):
+    """True where (xs[k], ys[k]) lies inside the polygon with vertices (px, py) and bounds bbox."""
+    n = px.shape[0]
+    inside = np.zeros(xs.shape[0], dtype=np.bool_)
+    for k in prange(xs.shape[0]):
+        x = xs[k]
+        y = ys[k]
+        # Most vehicles are nowhere near the junction: four comparisons reject them
+        if x < bbox[0] or y < bbox[1] or x > bbox[2] or y > bbox[3]:
+            continue
+        crossings = False
+        j = n - 1
+        for i in range(n):
+            # Edge (j, i) straddles the horizontal through y and crosses it right of x
+            if (py[i] > y) != (py[j] > y) and x < (px[j] - px[i]) * (y - py[i]) / (py[j] - py[i]) + px[i]:
+                crossings = not crossings
+            j = i
+        inside[k] = crossings
+    return inside
 
 # === START SUMO ===
 sumoCmd = [
@@ -34,10 +56,14 @@ step = 0
 while traci.simulation.getMinExpectedNumber() > 0:
     traci.simulationStep()
 
-    for veh_id in traci.vehicle.getIDList():
-        x, y = traci.vehicle.getPosition(veh_id)
-        inside = is_inside_junction(x, y)
+    # Test every vehicle against the junction polygon in one compiled call
+    veh_ids = traci.vehicle.getIDList()
+    positions = [traci.vehicle.getPosition(veh_id) for veh_id in veh_ids]
+    xs = np.fromiter((p[0] for p in positions), dtype=np.float64, count=len(positions))
+    ys = np.fromiter((p[1] for p in positions), dtype=np.float64, count=len(positions))
+    inside_mask = points_in_poly(xs, ys, junction_x, junction_y, junction_bbox)
 
+    for veh_id, inside in zip(veh_ids, inside_mask):
         if inside:
             if veh_id not in vehicle_times:
                 vtype = traci.vehicle.getTypeID(veh_id)
